@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Kent A. Vander Velden <kent.vandervelden@gmail.com>
+#
+# If you use this software, please consider contacting me. I'd like to hear
+# about your work.
+#
+# This file is part of TEC-controller
+#
+# Please see LICENSE for limitations on use.
+
+# Performance of recorded runs, per segment between changes of the target
+# temperature. Run logs are memory-mapped and each is reduced with NumPy in one
+# pass over its segments; many logs are spread across a process pool. Settling
+# and overshoot are as autotune.step_metrics defines them, for the temperature
+# the controller acted on, which is the estimate in runs with an estimator. A
+# segment is cut where its log ends, as logs are rotated.
+#   $ python analyze.py runs                      Every log in runs
+#   $ python analyze.py runs/*.tecrun --csv out.csv --min-duration 600
+
+import argparse
+import concurrent.futures
+import csv
+import glob
+import os
+import time
+
+import numpy as np
+
+import runlog
+
+columns = ['start', 'duration', 'target', 'settling', 'overshoot', 'ss_err', 'rms_err', 'energy', 'mean_w',
+           'eff_mean', 'eff_min', 'eff_max', 'steps']
+
+
+def segment_metrics(rec, band=.2, min_w=.1):
+    # rec is a run log's records. Returns a dict of per-segment arrays, one for
+    # each of columns: start and duration in s of the run's time t, settling in
+    # s, inf if the segment ends outside +-band of target, overshoot, steady
+    # state error and rms err in C, energy in J, mean power in W and delta_eff
+    # in C/W over the steps drawing at least min_w, as it is meaningless near
+    # zero power. The steady state is the part of the segment after it settles.
+    t = np.asarray(rec['t'])
+    n = len(t)
+    if not n:
+        return {k: np.zeros(0) for k in columns}
+    y = np.asarray(rec['t1'])
+    target = np.asarray(rec['target_temp'])
+    w = np.asarray(rec['total_w'])
+    eff = np.asarray(rec['delta_eff'])
+    err = y - target
+
+    starts = np.flatnonzero(np.r_[True, target[1:] != target[:-1]])
+    ends = np.r_[starts[1:], n]
+    steps = ends - starts
+    seg = np.repeat(np.arange(len(starts)), steps)
+    idx = np.arange(n)
+
+    direction = np.sign(target[starts] - y[starts])
+    overshoot = np.maximum(np.maximum.reduceat((y - target) * direction[seg], starts), 0.)
+
+    last_out = np.maximum.reduceat(np.where(np.abs(err) > band, idx, -1), starts)
+    settling = np.where(last_out == ends - 1, np.inf, t[np.minimum(last_out + 1, ends - 1)] - t[starts])
+    settling = np.where(last_out < 0, 0., settling)
+
+    after = idx > last_out[seg]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ss_err = np.add.reduceat(np.where(after, err, 0.), starts) / np.add.reduceat(after, starts)
+        rms_err = np.sqrt(np.add.reduceat(err * err, starts) / steps)
+
+        # Each step's power is held until the next step
+        held = np.r_[np.diff(t), 0.]
+        energy = np.add.reduceat(w * held, starts)
+        duration = np.add.reduceat(held, starts)
+        mean_w = energy / duration
+
+        ok = np.isfinite(eff) & (w >= min_w)
+        eff_mean = np.add.reduceat(np.where(ok, eff, 0.), starts) / np.add.reduceat(ok, starts)
+        eff_min = np.minimum.reduceat(np.where(ok, eff, np.inf), starts)
+        eff_max = np.maximum.reduceat(np.where(ok, eff, -np.inf), starts)
+    eff_min[~np.isfinite(eff_min)] = np.nan
+    eff_max[~np.isfinite(eff_max)] = np.nan
+
+    return {'start': t[starts], 'duration': duration, 'target': target[starts], 'settling': settling,
+            'overshoot': overshoot, 'ss_err': ss_err, 'rms_err': rms_err, 'energy': energy, 'mean_w': mean_w,
+            'eff_mean': eff_mean, 'eff_min': eff_min, 'eff_max': eff_max, 'steps': steps}
+
+
+def analyze_run(fn, band=.2):
+    _, rec = runlog.open_run(fn)
+    return fn, segment_metrics(rec, band)
+
+
+def analyze(fns, workers=None, band=.2):
+    # Metrics of every log, in the order given, computed across a process pool.
+    # Only the per-segment results are sent back from the workers.
+    workers = workers or os.cpu_count() or 1
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(analyze_run, fn, band) for fn in fns]
+        return [f.result() for f in futures]
+
+
+def find_runs(paths):
+    fns = []
+    for p in paths:
+        if os.path.isdir(p):
+            fns += sorted(glob.glob(os.path.join(p, '*.tecrun')))
+        else:
+            fns.append(p)
+    return fns
+
+
+def table_rows(results, min_duration=0.):
+    for fn, m in results:
+        for k in range(len(m['start'])):
+            if m['duration'][k] >= min_duration:
+                yield {'run': fn, **{c: m[c][k].item() for c in columns}}
+
+
+def print_table(rows):
+    print(f'{"run":32} {"start":>8} {"target":>7} {"duration":>9} {"settling":>9} {"overshoot":>9} '
+          f'{"ss err":>8} {"rms err":>8} {"energy":>9} {"power":>7} {"delta_eff":>9}')
+    for r in rows:
+        print(f'{os.path.basename(r["run"]):32} {r["start"]:7.0f}s {r["target"]:6.2f}C {r["duration"]:8.0f}s '
+              f'{r["settling"]:8.0f}s {r["overshoot"]:8.2f}C {r["ss_err"]:7.3f}C {r["rms_err"]:7.3f}C '
+              f'{r["energy"] / 3600:7.2f}Wh {r["mean_w"]:6.2f}W {r["eff_mean"]:5.2f}C/W')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Settling, error and energy of recorded runs')
+    parser.add_argument('paths', nargs='+', help='run logs, or directories of them')
+    parser.add_argument('--band', type=float, default=.2, help='settled within +-band of the target, C')
+    parser.add_argument('--min-duration', type=float, default=0., help='leave out shorter segments, s')
+    parser.add_argument('--workers', type=int, help='processes, default one per core')
+    parser.add_argument('--csv', help='also write the table to this file')
+    args = parser.parse_args()
+
+    fns = find_runs(args.paths)
+    st = time.perf_counter()
+    results = analyze(fns, args.workers, args.band)
+    et = time.perf_counter()
+
+    table = list(table_rows(results, args.min_duration))
+    print_table(table)
+    steps = sum(int(m['steps'].sum()) for _, m in results)
+    print(f'Analyzed {len(fns)} runs, {steps} steps, {len(table)} segments in {et - st:.2f} s')
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, ['run'] + columns)
+            writer.writeheader()
+            writer.writerows(table)
+
+
+if __name__ == "__main__":
+    main()
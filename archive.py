@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Kent A. Vander Velden <kent.vandervelden@gmail.com>
+#
+# If you use this software, please consider contacting me. I'd like to hear
+# about your work.
+#
+# This file is part of TEC-controller
+#
+# Please see LICENSE for limitations on use.
+
+# Persistent, fixed-size history of the telemetry channels for runs lasting
+# weeks, in the manner of RRDtool. An archive is a directory of memory-mapped
+# .npy files, written in place as samples come and never growing:
+#
+#   archive.json    The channels and the layout
+#   state.npy       Samples appended to the raw ring
+#   raw.npy         The last raw_capacity samples, time then the channels
+#   tier-<w>.npy    Minimum, sum and maximum of time and each channel over
+#                   buckets w seconds wide, with the bucket and the count
+#
+# The defaults keep the raw samples of the last hour at 4 per second, 10 s
+# buckets for a day, 1 min ones for a week and 10 min ones for a year. A bucket
+# has a fixed slot, its number modulo the tier's capacity, so an update touches
+# one row per tier and a reader finds any range without searching. Times are
+# wall clock seconds, so an archive continues across restarts.
+#
+#   $ python archive.py info archive             Span and fill of each level
+#   $ python archive.py plot archive --hours 48  View the last two days
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+tiers_default = ((10, 8640), (60, 10080), (600, 52560))
+
+
+class Archive:
+    # Opens the archive in path, creating it with channels if there is none.
+    # Opened with mode 'r' it is read only, and can be read while another
+    # process writes it. There is one writer at a time.
+
+    def __init__(self, path, channels=None, raw_capacity=4 * 3600, tiers=tiers_default, mode='r+'):
+        self.path = path
+        fn = os.path.join(path, 'archive.json')
+        if not os.path.exists(fn):
+            if channels is None or mode == 'r':
+                raise FileNotFoundError(f'No archive in {path}')
+            self.create(channels, raw_capacity, tiers)
+
+        with open(fn) as f:
+            layout = json.load(f)
+        self.channels = layout['channels']
+        if channels is not None and list(channels) != self.channels:
+            raise ValueError(f'Archive {path} has channels {self.channels}')
+        self.rows = {k: i + 1 for i, k in enumerate(self.channels)}
+
+        self.maps = []
+
+        def load(name):
+            # Plain arrays over the mapping, indexing a np.memmap is much slower
+            self.maps.append(np.load(os.path.join(path, name), mmap_mode=mode))
+            return np.asarray(self.maps[-1])
+
+        self.state = load('state.npy')
+        self.raw = load('raw.npy')
+        self.tiers = {w: load(f'tier-{w}.npy') for w, _ in layout['tiers']}
+
+    def create(self, channels, raw_capacity, tiers):
+        os.makedirs(self.path, exist_ok=True)
+        m = len(channels) + 1
+
+        def make(name, shape, dtype, fill):
+            a = np.lib.format.open_memmap(os.path.join(self.path, name), mode='w+', dtype=dtype, shape=shape)
+            a[:] = fill
+            a.flush()
+
+        make('state.npy', (1,), np.int64, 0)
+        make('raw.npy', (raw_capacity, m), np.float64, np.nan)
+        for w, capacity in tiers:
+            make(f'tier-{w}.npy', (capacity, 2 + 3 * m), np.float64, np.nan)
+        # Written last, so a partly created archive is not taken for one
+        with open(os.path.join(self.path, 'archive.json'), 'w') as f:
+            json.dump({'channels': list(channels), 'raw_capacity': raw_capacity, 'tiers': tiers}, f)
+
+    @property
+    def n(self):
+        return int(self.state[0])
+
+    def append(self, t, values):
+        # values maps each channel to its value, as for TelemetryRing.append()
+        col = [t] + [values[k] for k in self.channels]
+        m = len(col)
+
+        n = int(self.state[0])
+        self.raw[n % len(self.raw)] = col
+        self.state[0] = n + 1
+
+        for w, a in self.tiers.items():
+            b = t // w
+            row = a[int(b % len(a))]
+            if row[0] != b:
+                # The bucket is set last, so a reader never takes the old values for it
+                row[2:] = col * 3
+                row[1] = 1
+                row[0] = b
+            else:
+                r = row[2:].reshape(3, m)  # Minimums, sums and maximums
+                np.fmin(r[0], col, out=r[0])
+                r[1] += col
+                np.fmax(r[2], col, out=r[2])
+                row[1] += 1
+
+    def flush(self):
+        for a in self.maps:
+            a.flush()
+
+    def raw_view(self, x0=None, x1=None):
+        # The retained raw samples between times x0 and x1, a (channels + 1, k) array like TelemetryRing.view()
+        n = self.n
+        cap = len(self.raw)
+        idx = np.arange(max(n - cap, 0), n) % cap
+        v = self.raw[idx].T
+        i0 = 0 if x0 is None else np.searchsorted(v[0], x0)
+        i1 = v.shape[1] if x1 is None else np.searchsorted(v[0], x1, 'right')
+        return v[:, i0:i1]
+
+    def rollup(self, w, x0, x1):
+        # Buckets of tier w between times x0 and x1 that hold samples. Returns a
+        # dict of 'bucket' start times and 'count', and 'min', 'mean' and 'max',
+        # (channels + 1, k) arrays whose row 0 is time.
+        a = self.tiers[w]
+        m = len(self.channels) + 1
+        b = np.arange(x0 // w, x1 // w + 1)
+        b = b[-len(a):]  # Older buckets have been overwritten
+        rows = a[(b % len(a)).astype(np.int64)]
+        rows = rows[rows[:, 0] == b]
+        return {'bucket': rows[:, 0] * w, 'count': rows[:, 1],
+                'min': rows[:, 2:2 + m].T, 'mean': (rows[:, 2 + m:2 + 2 * m] / rows[:, 1:2]).T,
+                'max': rows[:, 2 + 2 * m:].T}
+
+    def span(self):
+        # Times of the oldest and the newest sample retained at any level, or None if empty
+        n = self.n
+        if not n:
+            return None
+        first = self.raw[max(n - len(self.raw), 0) % len(self.raw), 0]
+        for a in self.tiers.values():
+            used = a[np.isfinite(a[:, 0])]
+            if len(used):
+                first = min(first, used[:, 2].min())
+        return first, self.raw[(n - 1) % len(self.raw), 0]
+
+    def view(self, x0, x1, pixels):
+        # Points for plotting [x0, x1] on pixels columns, like MinMaxDecimator.view().
+        # Raw samples if there are few enough, else the minimum and maximum of each
+        # bucket of the finest tier that has at most two points per pixel, or of the
+        # coarsest. Raw samples are used only if they reach back to x0.
+        v = self.raw_view(x0, x1)
+        if v.shape[1] <= 2 * pixels and (self.n <= len(self.raw) or (v.shape[1] and v[0, 0] <= x0 + 60)):
+            return v
+
+        ws = sorted(self.tiers)
+        w = next((w for w in ws if (x1 - x0) / w <= pixels), ws[-1])
+        r = self.rollup(w, x0, x1)
+        out = np.empty((len(self.channels) + 1, 2 * len(r['count'])))
+        out[:, 0::2] = r['min']
+        out[:, 1::2] = r['max']
+        return out
+
+
+def info(args):
+    a = Archive(args.path, mode='r')
+    span = a.span()
+    print(f'{args.path}: {len(a.channels)} channels, {a.n} samples appended')
+    if span is not None:
+        print(f'  from {time.ctime(span[0])} to {time.ctime(span[1])}')
+    v = a.raw_view()
+    if v.shape[1]:
+        print(f'  raw: {v.shape[1]} of {len(a.raw)} samples, {(v[0, -1] - v[0, 0]) / 3600:.2f} h')
+    for w, t in a.tiers.items():
+        used = np.isfinite(t[:, 0]).sum()
+        print(f'  {w} s: {used} of {len(t)} buckets, {used * w / 3600:.1f} of {len(t) * w / 3600:.0f} h')
+
+
+def plot(args):
+    from PyQt5 import QtWidgets
+
+    import tec_gui
+
+    a = Archive(args.path, mode='r')
+    span = a.span()
+    if span is None:
+        print(f'{args.path}: empty')
+        return
+    x1 = span[1] if args.end is None else span[1] - args.end * 3600
+    x0 = x1 - args.hours * 3600
+
+    app = QtWidgets.QApplication([])
+    canvas = tec_gui.MplCanvas(width=5, height=4, dpi=100, blit=False)
+    canvas.setWindowTitle(f'{args.path}: {time.ctime(x0)} to {time.ctime(x1)}')
+    canvas.resize(1920, 1080)
+    canvas.show()
+    canvas.show_archive(a, x0, x1)
+    app.exec_()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Multi-resolution history of TEC runs')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+
+    p = sub.add_parser('info', help='span and fill of each level')
+    p.add_argument('path')
+    p.set_defaults(fn=info)
+
+    p = sub.add_parser('plot', help='view a time range')
+    p.add_argument('path')
+    p.add_argument('--hours', type=float, default=24., help='length of the range')
+    p.add_argument('--end', type=float, help='hours before the newest sample the range ends')
+    p.set_defaults(fn=plot)
+
+    args = parser.parse_args()
+    args.fn(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Kent A. Vander Velden <kent.vandervelden@gmail.com>
+#
+# If you use this software, please consider contacting me. I'd like to hear
+# about your work.
+#
+# This file is part of TEC-controller
+#
+# Please see LICENSE for limitations on use.
+
+# PID auto-tuning, from the top of the repo. Both modes print gain sets ranked by
+# settling time and then overshoot, and --write stores the best in config.txt.
+#   $ python autotune.py relay              Relay experiment on the bench, near the configured target
+#   $ python autotune.py relay --sim        The same against the simulated bench
+#   $ python autotune.py offline --target 15 --kp 1 2 4 8 --ki .002 .005 .01 --kd 0 1 4
+#
+# The relay experiment (Astrom and Hagglund) replaces the PID with a relay around
+# the current holding the target. The resulting oscillation gives the ultimate gain
+# Ku and period Pu, and with the delay to each peak a first order plus dead time
+# model, on which the classic tuning rules are compared. The offline search runs
+# closed-loop steps of the simulated plant over a grid of gains in a process pool.
+
+import argparse
+import concurrent.futures
+import itertools
+import math
+import os
+import time
+
+import numpy as np
+
+import tec_control
+from sim.thermal import TECPlant
+
+
+class RelayTuner:
+    # Passed to TEC_Controller.start_tune, which calls step() in place of the PID
+    # until done. The relay adds amplitude A to the bias current while err is
+    # above the hysteresis band and subtracts it below. The first cycle is
+    # discarded, then cycles are measured. bias defaults to the current the
+    # controller is applying when the experiment starts.
+
+    law = 1  # Recorded in the run log, see controllers
+
+    def __init__(self, amplitude=1., hysteresis=.15, cycles=3, bias=None, max_i=6., timeout=4 * 3600.):
+        self.amplitude = amplitude
+        self.hysteresis = hysteresis
+        self.cycles = cycles
+        self.bias = bias
+        self.max_i = max_i
+        self.timeout = timeout
+
+        self.t0 = None
+        self.state = 0
+        self.switches = []  # Time of each relay switch
+        self.peaks = []  # (t, err) of the extremum of err following each switch
+        self.ext = None
+        self.done = False
+        self.failed = None
+
+    def step(self, t, err):
+        if self.t0 is None:
+            self.t0 = t
+            self.state = 1 if err > 0 else -1
+
+        # Extremum since the last switch, a maximum after switching to more cooling
+        if self.switches and (self.ext is None or self.state * (err - self.ext[1]) > 0):
+            self.ext = (t, err)
+
+        if (self.state < 0 and err > self.hysteresis) or (self.state > 0 and err < -self.hysteresis):
+            if self.ext is not None:
+                self.peaks.append(self.ext)
+            self.ext = None
+            self.switches.append(t)
+            self.state = -self.state
+
+        if len(self.switches) > 2 * (self.cycles + 1):
+            self.done = True
+        elif t - self.t0 > self.timeout:
+            self.done = True
+            self.failed = f'no sustained oscillation after {t - self.t0:.0f} s'
+
+        return float(np.clip(self.bias + self.state * self.amplitude, -self.max_i, self.max_i))
+
+    def result(self):
+        # Ku, Pu and the model from the measured cycles, with the rule gains ranked
+        # on the model. If no model fits, the rule gains are still given, most
+        # cautious first, without settling or overshoot, and model is None.
+        if self.failed:
+            return {'failed': self.failed}
+
+        n = 2 * self.cycles
+        sw = np.array(self.switches[-n - 1:])
+        peaks = np.array(self.peaks[-n:])
+        pu = float(np.mean(sw[2:] - sw[:-2]))
+        hi = peaks[:, 1][peaks[:, 1] > 0].mean()
+        lo = peaks[:, 1][peaks[:, 1] < 0].mean()
+        a = (hi - lo) / 2
+        ku = 4 * self.amplitude / (math.pi * math.sqrt(max(a * a - self.hysteresis ** 2, 1e-12)))
+        dead = float(np.mean(peaks[:, 0] - sw[:-1]))
+        lag = math.asin(min(self.hysteresis / a, 1.))
+
+        res = {'ku': ku, 'pu': pu, 'amplitude': a, 'dead_time': dead, 'bias': self.bias}
+        candidates = rule_gains(ku, pu)
+        gains = np.array([c[1:] for c in candidates])
+        names = [c[0] for c in candidates]
+        model = fopdt_from_relay(ku, pu, dead, lag)
+        if model is None:
+            nan = np.full(len(gains), np.nan)
+            ranked = rank(gains, nan, nan, names)
+            ranked.sort(key=lambda r: r['kp'])
+            return dict(res, model=None, ranked=ranked)
+
+        t, y = simulate_fopdt(gains, *model, max_i=self.max_i)
+        settling, overshoot = step_metrics(t, y, -1.)
+        ranked = rank(gains, settling, overshoot, names)
+        return dict(res, model=dict(zip(('gain', 'tau', 'dead_time'), model)), ranked=ranked)
+
+    def summary(self):
+        res = self.result()
+        s = format_result(res)
+        if 'ranked' in res:
+            best = res['ranked'][0]
+            s += f', {"best" if res["model"] else "first"} {best["name"]} kp:{best["kp"]:.4g} ki:{best["ki"]:.4g} kd:{best["kd"]:.4g}'
+        return s
+
+
+def fopdt_from_relay(ku, pu, dead, lag=0.):
+    # Gain (C/A of cooling), time constant and dead time of the first order plus
+    # dead time model that oscillates with the relay at Pu. The relay's
+    # hysteresis delays its switching by lag, asin(hysteresis / amplitude), so
+    # the plant's phase there is lag short of -180 degrees, and its gain is that
+    # of the relay's describing function, 1 / (Ku cos(lag)). The lag of the time
+    # constant is under 90 degrees, so the dead time must make up the rest, else
+    # the measurements fit no such model and this returns None.
+    w = 2 * math.pi / pu
+    phase = math.pi - lag - w * dead
+    if not 0 < phase < math.pi / 2:
+        return None
+    tau = math.tan(phase) / w
+    gain = math.sqrt(1 + (w * tau) ** 2) / (ku * math.cos(lag))
+    return gain, tau, dead
+
+
+def rule_gains(ku, pu):
+    # (name, kp, ki, kd) from the classic rules on Ku and Pu, as (kp, Ti, Td)
+    rules = [('ziegler-nichols', .6 * ku, pu / 2, pu / 8),
+             ('some-overshoot', ku / 3, pu / 2, pu / 3),
+             ('no-overshoot', ku / 5, pu / 2, pu / 3),
+             ('tyreus-luyben', ku / 2.2, 2.2 * pu, pu / 6.3),
+             ('tyreus-luyben-pi', ku / 3.2, 2.2 * pu, 0.)]
+    return [(name, kp, kp / ti, kp * td) for name, kp, ti, td in rules]
+
+
+def simulate_fopdt(gains, gain, tau, dead, step=-1., duration=None, period=1.5, max_i=6.):
+    # Closed-loop responses to a setpoint step of the linear model around the
+    # operating point, for the (n, 3) gain sets at once. Positive current cools.
+    # Returns the times and temperatures, the latter (n, steps).
+    if duration is None:
+        duration = 20 * (tau + dead)
+    steps = int(duration / period) + 1
+    delay = int(round(dead / period))
+    decay = 1 - math.exp(-period / tau)
+
+    kp, ki, kd = (gains[:, k] for k in range(3))
+    n = len(gains)
+    y = np.zeros(n)
+    u = np.zeros((delay + 1, n))  # Pending currents, applied in order
+    term_i = np.zeros(n)
+    p_err = np.full(n, -step)
+    out = np.empty((n, steps))
+    for k in range(steps):
+        out[:, k] = y
+        err = y - step
+        _, term_i, _, _, pid_i = tec_control.pid_step(err, p_err, period, term_i, kp, ki, kd, max_i)
+        p_err = err
+        u = np.roll(u, -1, axis=0)
+        u[-1] = pid_i
+        y = y + decay * (-gain * u[0] - y)
+    return np.arange(steps) * period, out
+
+
+def step_metrics(t, y, target, band=.2):
+    # Settling time into +-band of target, and overshoot past it in C, of the
+    # responses y (n, steps). Responses that never settle take inf.
+    start = y[:, :1]
+    direction = np.sign(target - start)
+    overshoot = np.maximum(((y - target) * direction).max(axis=1), 0.)
+    outside = np.abs(y - target) > band
+    last = y.shape[1] - 1 - np.argmax(outside[:, ::-1], axis=1)
+    settling = np.where(outside[:, -1], np.inf, t[np.minimum(last + 1, len(t) - 1)] - t[0])
+    settling = np.where(outside.any(axis=1), settling, 0.)
+    return settling, overshoot
+
+
+def rank(gains, settling, overshoot, names=None):
+    # Gain sets as dicts, fastest to settle first, then least overshoot
+    order = np.lexsort((overshoot, settling))
+    return [{'name': None if names is None else names[k],
+             'kp': float(gains[k, 0]), 'ki': float(gains[k, 1]), 'kd': float(gains[k, 2]),
+             'settling': float(settling[k]), 'overshoot': float(overshoot[k])} for k in order]
+
+
+def simulate_plant(gains, target, ambient=25., duration=3 * 3600., period=1.5, max_i=6., supply_v=12.):
+    # Closed-loop runs of TECPlant from ambient to target as the controller would
+    # drive the bench, one gain set at a time. Returns the times and t1 (n, steps).
+    steps = int(duration / period)
+    out = np.empty((len(gains), steps))
+    for j, (kp, ki, kd) in enumerate(gains):
+        plant = TECPlant(ambient)
+        term_i = 0.
+        p_err = None
+        i = 0.
+        for k in range(steps):
+            plant.advance(period, math.copysign(min(abs(i), plant.max_current(supply_v)), i))
+            t1 = round(plant.t_load, 1)
+            out[j, k] = t1
+            err = t1 - target
+            if p_err is not None:
+                _, term_i, _, _, i = tec_control.pid_step(err, p_err, period, term_i, kp, ki, kd, max_i)
+            p_err = err
+    return (np.arange(steps) + 1) * period, out
+
+
+def evaluate_plant(gains, target, band=.2, **kwargs):
+    t, y = simulate_plant(gains, target, **kwargs)
+    return step_metrics(t, y, target, band)
+
+
+def offline_search(kps, kis, kds, target, workers=None, band=.2, **kwargs):
+    # Every combination of the gains, evaluated in chunks across a process pool
+    gains = np.array(list(itertools.product(kps, kis, kds)), dtype=float).reshape(-1, 3)
+    workers = workers or os.cpu_count() or 1
+    chunks = np.array_split(gains, min(len(gains), workers * 4))
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(evaluate_plant, c, target, band, **kwargs) for c in chunks]
+        results = [f.result() for f in futures]
+    settling = np.concatenate([r[0] for r in results])
+    overshoot = np.concatenate([r[1] for r in results])
+    return rank(gains, settling, overshoot)
+
+
+def write_config(fn, target_temp, kp, ki, kd):
+    # The format of TEC_Controller.save_config
+    with open(fn, 'w') as f:
+        print(f'{target_temp} {kp} {ki} {kd}', file=f)
+
+
+def print_ranked(ranked, top):
+    print(f'{"":16} {"kp":>8} {"ki":>8} {"kd":>8} {"settling":>10} {"overshoot":>10}')
+    for r in ranked[:top]:
+        # Unranked gains have neither
+        settling = f'{r["settling"]:9.0f}s' if np.isfinite(r['overshoot']) else f'{"-":>10}'
+        overshoot = f'{r["overshoot"]:9.2f}C' if np.isfinite(r['overshoot']) else f'{"-":>10}'
+        print(f'{r["name"] or "":16} {r["kp"]:8.4g} {r["ki"]:8.4g} {r["kd"]:8.4g} {settling} {overshoot}')
+
+
+def format_result(res):
+    if 'failed' in res:
+        return f'Relay tune failed: {res["failed"]}'
+    m = res['model']
+    s = (f'Relay tune: Ku:{res["ku"]:.4g}A/C Pu:{res["pu"]:.1f}s amplitude:{res["amplitude"]:.3f}C '
+         f'bias:{res["bias"]:.3f}A, ')
+    if m is None:
+        return s + f'no first order plus dead time model fits dead time {res["dead_time"]:.1f}s, gains unranked'
+    return s + f'model gain:{m["gain"]:.3g}C/A tau:{m["tau"]:.1f}s dead time:{m["dead_time"]:.1f}s'
+
+
+def run_relay(args):
+    tuner = RelayTuner(args.amplitude, args.hysteresis, args.cycles)
+
+    if args.sim:
+        from sim.fake_dp832 import FakeDP832
+        from sim.fake_ea15 import SimEA15
+
+        plant = TECPlant(ambient=args.ambient)
+        ea15 = SimEA15()
+        tec = tec_control.TEC_Controller(ea15=ea15, instr=FakeDP832(plant), clock=lambda: plant.t)
+        if args.target is not None:
+            tec.target_temp = args.target
+        tec.setup()
+
+        def advance(seconds):
+            for k in range(int(seconds / 1.5)):
+                plant.advance(1.5)
+                ea15.put(plant.t, plant.t_load, plant.t_sink)
+                tec.step()
+                if tec.tuner is None and tec.tune_result is not None:
+                    break
+
+        advance(args.settle)
+        tec.start_tune(tuner)
+        advance(tuner.timeout + 1.5)
+        tec.shutdown()
+    else:
+        tec = tec_control.TEC_Controller()
+        if args.target is not None:
+            tec.target_temp = args.target
+        tec.setup()
+        worker = tec_control.ControlWorker(tec, event_driven=True)
+        worker.start()
+        try:
+            print(f'Settling for {args.settle:.0f} s')
+            time.sleep(args.settle)
+            worker.submit(tec.start_tune, tuner)
+            while tec.tune_result is None:
+                time.sleep(1.)
+        finally:
+            worker.stop()
+            tec.shutdown()
+
+    res = tec.tune_result  # Already printed by the controller
+    if 'failed' in res:
+        return None
+    print_ranked(res['ranked'], args.top)
+    return tec.target_temp, res['ranked']
+
+
+def run_offline(args):
+    st = time.monotonic()
+    ranked = offline_search(args.kp, args.ki, args.kd, args.target, workers=args.workers, band=args.band,
+                            ambient=args.ambient, duration=args.hours * 3600)
+    print(f'{len(ranked)} gain sets in {time.monotonic() - st:.1f} s, '
+          f'from {args.ambient}C to {args.target}C within {args.band}C')
+    print_ranked(ranked, args.top)
+    return args.target, ranked
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Auto-tune the TEC controller PID')
+    sub = parser.add_subparsers(dest='mode', required=True)
+
+    p = sub.add_parser('relay', help='relay-feedback experiment')
+    p.add_argument('--sim', action='store_true', help='against the simulated bench')
+    p.add_argument('--target', type=float, help='default the configured target temperature')
+    p.add_argument('--settle', type=float, default=1800., help='seconds of PID control before the relay')
+    p.add_argument('--amplitude', type=float, default=1., help='relay amplitude, A')
+    p.add_argument('--hysteresis', type=float, default=.15, help='relay hysteresis, C')
+    p.add_argument('--cycles', type=int, default=3, help='oscillations measured')
+    p.add_argument('--ambient', type=float, default=25., help='simulated ambient temperature, C')
+
+    p = sub.add_parser('offline', help='grid search over the simulated plant')
+    p.add_argument('--target', type=float, required=True, help='step target from ambient, C')
+    p.add_argument('--kp', type=float, nargs='+', default=[.5, 1, 2, 4, 8])
+    p.add_argument('--ki', type=float, nargs='+', default=[0, .002, .005, .01, .02])
+    p.add_argument('--kd', type=float, nargs='+', default=[0, .5, 2, 8])
+    p.add_argument('--ambient', type=float, default=25., help='ambient temperature, C')
+    p.add_argument('--hours', type=float, default=3., help='simulated duration of each step')
+    p.add_argument('--band', type=float, default=.2, help='settling band, C')
+    p.add_argument('--workers', type=int, help='processes, default one per CPU')
+
+    for p in sub.choices.values():
+        p.add_argument('--top', type=int, default=10, help='gain sets printed')
+        p.add_argument('--write', action='store_true', help='store the best gains in config.txt')
+    args = parser.parse_args()
+
+    res = run_relay(args) if args.mode == 'relay' else run_offline(args)
+    if res is not None and args.write:
+        target_temp, ranked = res
+        best = ranked[0]
+        write_config('config.txt', target_temp, best['kp'], best['ki'], best['kd'])
+        print(f'Wrote config.txt: {target_temp} {best["kp"]:.6g} {best["ki"]:.6g} {best["kd"]:.6g}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Kent A. Vander Velden <kent.vandervelden@gmail.com>
+#
+# If you use this software, please consider contacting me. I'd like to hear
+# about your work.
+#
+# This file is part of TEC-controller
+#
+# Please see LICENSE for limitations on use.
+
+# Headless benchmarks of the hot paths, run from the top of the repo
+#   $ python benchmark.py                    Run and compare against bench_baseline.json
+#   $ python benchmark.py --save             Run and store the results as the new baseline
+#   $ python benchmark.py decode datalog     Run only some scenarios
+# Exits with 1 if any result is worse than the baseline by more than --tolerance.
+# The committed baseline was taken on a development machine; store a new one
+# with --save when comparing on other hardware.
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+import extech_ea15
+import tec_control
+import telemetry
+from sim.fake_dp832 import FakeDP832
+from sim.fake_ea15 import FakeEA15, SimEA15, encode_datalog, encode_reading
+from sim.thermal import TECPlant
+
+baseline_fn = 'bench_baseline.json'
+
+
+def best_of(fn, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        st = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - st)
+    return best
+
+
+def random_temps(rng, n):
+    return [(rng.uniform(-50, 150), rng.uniform(-50, 150)) for _ in range(n)]
+
+
+class DecoderStub(extech_ea15.ExtechEA15Serial):
+    # The decoding methods without a serial port
+    def __init__(self):
+        self.framer = extech_ea15.ExtechEA15Framer()
+
+
+def bench_decode():
+    # Framing and decoding of a stream of live readings, fed in 64-byte reads
+    rng = random.Random(0)
+    n = 20000
+    stream = b''.join(encode_reading(t1, t2) for t1, t2 in random_temps(rng, n))
+    chunks = [stream[i:i + 64] for i in range(0, len(stream), 64)]
+    dec = DecoderStub()
+
+    def run():
+        framer = extech_ea15.ExtechEA15Framer()
+        for c in chunks:
+            for packet_type, buf, t_ns in framer.feed(c):
+                dec.decode(buf)
+
+    return {'decode_packets_per_s': n / best_of(run)}
+
+
+def bench_datalog():
+    # A full logger memory, the largest dump the length packet can describe
+    rng = random.Random(0)
+    n = (0xffff - 0x8c80 - 5) // 7
+    _, dump = encode_datalog([(2, random_temps(rng, n))])
+    dec = DecoderStub()
+    start_dt = extech_ea15.datetime.datetime.now()
+
+    return {'decode_datalog_records_per_s': n / best_of(lambda: dec.decode_datalog(dump)),
+            'decode2_records_per_s': n / best_of(lambda: dec.decode2(dump, start_dt), repeat=2)}
+
+
+def bench_latency(n=200, period=.05):
+    # Time from the stand-in EA15 writing a reading to the pty to the controller's
+    # instrument transaction in response, through ExtechEA15Threaded and step()
+    plant = TECPlant()
+    written = []
+
+    def read_temps():
+        plant.advance(period)
+        written.append(time.monotonic())
+        return plant.t_load, plant.t_sink
+
+    class TimedDP832(FakeDP832):
+        def write(self, msg):
+            if ':MEAS:ALL?' in msg:
+                acted.append(time.monotonic())
+            super().write(msg)
+
+    acted = []
+    instr = TimedDP832(plant)
+    fake = FakeEA15(read_temps, period=period)
+    tec = tec_control.TEC_Controller(dev_fn=fake.dev_fn, instr=instr, verbose=False)
+    tec.setup()
+    acted.clear()
+    worker = tec_control.ControlWorker(tec, period=1., event_driven=True)
+    worker.start()
+    fake.start()
+    while len(acted) < n:
+        time.sleep(period)
+    worker.stop()
+    fake.stop()
+
+    # Pair each transaction with the last reading written before it
+    w = np.array(written)
+    a = np.array(acted[5:])
+    lat = a - w[np.searchsorted(w, a) - 1]
+    return {'latency_median_ms': float(np.median(lat) * 1e3),
+            'latency_p99_ms': float(np.percentile(lat, 99) * 1e3)}
+
+
+def bench_step():
+    # step() alone against the in-process stand-ins
+    plant = TECPlant()
+    ea15 = SimEA15()
+    tec = tec_control.TEC_Controller(ea15=ea15, instr=FakeDP832(plant), verbose=False, clock=lambda: plant.t)
+    tec.setup()
+    n = 5000
+
+    def run():
+        for _ in range(n):
+            plant.advance(1.5)
+            ea15.put(plant.t, plant.t_load, plant.t_sink)
+            tec.step()
+
+    return {'step_per_s': n / best_of(run, repeat=3)}
+
+
+def bench_redraw(sizes=(1000, 10000, 100000, 1000000), frames=20):
+    # Cost of a TEC_Window.update_plot frame with one new sample, as the history grows
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    import tec_gui as gui
+    app = gui.QtWidgets.QApplication.instance() or gui.QtWidgets.QApplication(sys.argv[:1])
+
+    canvas = gui.MplCanvas(None)
+    canvas.resize(1920, 1080)
+    canvas.show()
+    app.processEvents()
+
+    keys = list(canvas.axs)
+    history = telemetry.TelemetryRing(keys, max(sizes) + frames)
+    rng = np.random.default_rng(0)
+
+    def append():
+        t = history.n * 1.5
+        history.append(t, {k: np.sin(t / 500. + j) + rng.normal() * .01 for j, k in enumerate(keys)})
+
+    res = {}
+    for size in sizes:
+        while history.n < size:
+            append()
+        canvas.update_history(history)
+        app.processEvents()
+
+        st = time.perf_counter()
+        for _ in range(frames):
+            append()
+            canvas.update_history(history)
+            app.processEvents()
+        res[f'redraw_{size}_ms'] = (time.perf_counter() - st) / frames * 1e3
+
+    return res
+
+
+scenarios = {'decode': bench_decode,
+             'datalog': bench_datalog,
+             'step': bench_step,
+             'latency': bench_latency,
+             'redraw': bench_redraw}
+
+
+def worse(k, v, b, tolerance):
+    # Rates are better when higher, times when lower
+    if k.endswith('_per_s'):
+        return v < b * (1 - tolerance)
+    return v > b * (1 + tolerance)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the TEC controller hot paths')
+    parser.add_argument('scenarios', nargs='*', help=f'any of {", ".join(scenarios)}, default all')
+    parser.add_argument('--save', action='store_true', help=f'store results in {baseline_fn}')
+    parser.add_argument('--tolerance', type=float, default=.25, help='allowed fractional regression')
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in scenarios:
+            parser.error(f'unknown scenario: {name}')
+
+    try:
+        with open(baseline_fn) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = {}
+
+    results = {}
+    for name in args.scenarios or scenarios:
+        results.update(scenarios[name]())
+
+    regressed = False
+    for k, v in results.items():
+        b = baseline.get(k)
+        s = f'{k:32s} {v:14.3f}'
+        if b is not None:
+            s += f'  baseline {b:14.3f}  {(v - b) / b * 100:+7.1f}%'
+            if worse(k, v, b, args.tolerance):
+                s += '  REGRESSION'
+                regressed = True
+        print(s)
+
+    if args.save:
+        baseline.update(results)
+        with open(baseline_fn, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            print(file=f)
+
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Kent A. Vander Velden <kent.vandervelden@gmail.com>
+#
+# If you use this software, please consider contacting me. I'd like to hear
+# about your work.
+#
+# This file is part of TEC-controller
+#
+# Please see LICENSE for limitations on use.
+
+# Control laws TEC_Controller.step can use in place of its PID. A controller has
+#   law                   Code recorded in the run log, 0 is the built-in PID
+#   reset(i)              Called when it takes over, with the current being applied
+#   update(t, temp, target_temp, dt, i_applied)
+#                         Returns the current to apply from the next step. temp
+#                         is the sample, dt the time since the last one and
+#                         i_applied the current chosen last time, applied now.
+# autotune.RelayTuner is driven the same way through TEC_Controller.start_tune.
+
+import collections
+import math
+import time
+
+import numpy as np
+
+import metrics
+
+mpc_seconds = metrics.histogram('control_mpc_seconds', 'Time choosing the MPC current')
+
+
+class MPC:
+    # Model-predictive control on a first order plus dead time model with the
+    # TEC's static nonlinearity at its input. A current i held long enough moves
+    # the temperature by f(i) = -gain * i + joule * i^2: Peltier cooling is linear
+    # in the current and Joule heating grows with its square, so past the
+    # optimum, gain / (2 * joule), more current only warms and wastes power, so
+    # currents are limited to it. The response to f follows with time constant
+    # tau after dead_time, which includes the one step the controller applies its
+    # output late. The defaults are roughly the simulated bench; the model of
+    # autotune.RelayTuner's result can be passed in instead.
+    #
+    # Each update scores every candidate current trajectory over the horizon in
+    # one batch. A candidate holds one current for the first block steps and
+    # another for the rest, the first from a window around the current applied
+    # and the second from the whole range or the same as the first. The cost is
+    # the squared error to the target plus rho per A^2 of each change and
+    # switch_cost for reversing the polarity relay. The error between the model
+    # and the measurement is taken as a constant disturbance over the horizon,
+    # which removes steady offsets.
+    #
+    # The number of candidates adapts to budget, the fraction of the sample
+    # period the evaluation may take, by measuring each evaluation.
+
+    law = 2
+
+    def __init__(self, gain=16., tau=90., dead_time=6., joule=None, horizon=240., block=4, max_i=6., rho=.05,
+                 switch_cost=.5, window=1., budget=.05, levels=(5, 61)):
+        self.gain = gain
+        self.tau = tau
+        self.dead_time = dead_time
+        self.joule = gain / 10. if joule is None else joule
+        self.horizon = horizon  # s
+        self.block = block
+        self.max_i = min(max_i, gain / (2 * self.joule)) if self.joule > 0 else max_i
+        self.rho = rho
+        self.switch_cost = switch_cost
+        self.window = window  # A either side of the applied current for the first move
+        self.budget = budget
+        self.min_levels, self.max_levels = levels
+
+        self.levels = self.min_levels
+        self.cost_per_candidate = None  # Measured seconds per candidate
+        self.last_seconds = 0.
+        self.cache = (None, None)
+        self.reset(0.)
+
+    def reset(self, i):
+        self.x = None  # Model temperature change from f
+        self.pending = collections.deque()  # Currents applied, not yet past the dead time
+        self.i = i
+
+    def f(self, i):
+        return -self.gain * i + self.joule * i * i
+
+    def matrices(self, dt):
+        # The horizon's step count, decay per step and convolution matrix for dt
+        key = round(dt, 3)
+        if self.cache[0] != key:
+            steps = max(int(self.horizon / dt), self.block + 1)
+            phi = math.exp(-dt / self.tau)
+            j = np.arange(steps)
+            g = np.where(j[:, None] >= j[None, :], phi ** (j[:, None] - j[None, :]) * (1 - phi), 0.)
+            self.cache = (key, (steps, phi, phi ** (j + 1), g, max(int(round(self.dead_time / dt)), 0)))
+        return self.cache[1]
+
+    def candidates(self, i):
+        # Every pair of a first current and a second one, including holding the first
+        n = self.levels
+        first = np.clip(np.linspace(i - self.window, i + self.window, n), -self.max_i, self.max_i)
+        rest = np.linspace(-self.max_i, self.max_i, n)
+        u1 = np.repeat(first, n + 1)
+        u2 = np.tile(np.append(rest, np.nan), n)
+        return u1, np.where(np.isnan(u2), u1, u2)
+
+    def update(self, t, temp, target_temp, dt, i_applied):
+        st = time.perf_counter()
+        steps, phi, decay, g, delay = self.matrices(dt)
+
+        # Advance the model over the period just past
+        self.pending.append(i_applied)
+        while len(self.pending) > delay:
+            v = self.pending.popleft()
+            self.x = self.f(v) if self.x is None else phi * self.x + (1 - phi) * self.f(v)
+        x = 0. if self.x is None else self.x
+        offset = temp - x
+
+        # Inputs over the horizon: those already committed, then the candidate's
+        u1, u2 = self.candidates(i_applied)
+        n = len(u1)
+        u = np.empty((n, steps))
+        k = len(self.pending)
+        u[:, :k] = list(self.pending)[:steps]
+        u[:, k:k + self.block] = u1[:, None]
+        u[:, k + self.block:] = u2[:, None]
+
+        y = offset + decay * x + self.f(u) @ g.T
+        cost = ((y - target_temp) ** 2).sum(axis=1)
+        cost += self.rho * ((u1 - i_applied) ** 2 + (u2 - u1) ** 2)
+        cost += self.switch_cost * ((np.sign(u1) * np.sign(i_applied) < 0) + (np.sign(u2) * np.sign(u1) < 0))
+        self.i = float(u1[np.argmin(cost)])
+
+        # Size the next evaluation to the budget
+        self.last_seconds = time.perf_counter() - st
+        mpc_seconds.observe(self.last_seconds)
+        c = self.last_seconds / n
+        self.cost_per_candidate = c if self.cost_per_candidate is None else .8 * self.cost_per_candidate + .2 * c
+        self.levels = int(min(max(math.sqrt(self.budget * dt / self.cost_per_candidate), self.min_levels),
+                              self.max_levels))
+
+        return self.i
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Kent A. Vander Velden <kent.vandervelden@gmail.com>
+#
+# If you use this software, please consider contacting me. I'd like to hear
+# about your work.
+#
+# This file is part of TEC-controller
+#
+# Please see LICENSE for limitations on use.
+
+import time
+
+import vxi11
+
+import metrics
+
+write_seconds = metrics.histogram('dp832_write_seconds', 'Time in each VXI-11 write to a DP832')
+ask_seconds = metrics.histogram('dp832_ask_seconds', 'Time in each VXI-11 ask of a DP832')
+
+
+class DP832:
+    # Rigol DP832 over VXI-11 that remembers the last commanded setting of each
+    # channel, only sends settings that changed, and sends the pending settings
+    # and measurement queries of a step as one compound SCPI message. If the
+    # replies to a compound message can't be matched up, it falls back to one
+    # transaction per command.
+
+    def __init__(self, ip, compound=True, instr=None):
+        self.instr = vxi11.Instrument(ip) if instr is None else instr
+        self.compound = compound
+        self.pending = []
+        self.state = {}
+
+    def write(self, cmd):
+        # Sent immediately along with any pending settings
+        if cmd.startswith('*RST'):
+            self.state.clear()
+        self.pending += [cmd]
+        self.flush()
+
+    def ask(self, cmd):
+        return self.query([cmd])[0]
+
+    def set_(self, key, value, cmd):
+        if self.state.get(key) != value:
+            self.state[key] = value
+            self.pending += [cmd]
+
+    def set_current(self, ch, i):
+        # The DP832 has 1 mA resolution, smaller changes are not worth a write
+        i = round(i, 3)
+        self.set_(f':SOUR{ch}:CURR', i, f':SOUR{ch}:CURR {i:.3f}')
+
+    def set_output(self, ch, on):
+        self.set_(f':OUTP CH{ch}', on, f':OUTP CH{ch},{"ON" if on else "OFF"}')
+
+    def write_(self, msg):
+        st = time.perf_counter()
+        self.instr.write(msg)
+        write_seconds.observe(time.perf_counter() - st)
+
+    def ask_(self, msg):
+        st = time.perf_counter()
+        res = self.instr.ask(msg)
+        ask_seconds.observe(time.perf_counter() - st)
+        return res
+
+    def invalidate(self):
+        self.state.clear()
+
+    def flush(self):
+        if not self.pending:
+            return
+        if self.compound:
+            self.write_(';'.join(self.pending))
+        else:
+            for cmd in self.pending:
+                self.write_(cmd)
+        self.pending = []
+
+    def query(self, queries):
+        # Returns one reply per query, pending settings are sent first
+        if self.compound:
+            cmds = self.pending + queries
+            self.pending = []
+            res = self.ask_(';'.join(cmds)).split(';')
+            if len(res) == len(queries):
+                return res
+            print(f'Unexpected reply to compound command, sending commands separately: {res}')
+            self.compound = False
+            self.state.clear()
+            return [self.ask_(q) for q in queries]
+
+        self.flush()
+        return [self.ask_(q) for q in queries]
+
+    def measure_all(self, chs):
+        # [[volts, amps, watts], ...] for each channel in chs
+        res = self.query([f':MEAS:ALL? CH{ch}' for ch in chs])
+        return [[float(x) for x in r.split(',')] for r in res]
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Kent A. Vander Velden <kent.vandervelden@gmail.com>
+#
+# If you use this software, please consider contacting me. I'd like to hear
+# about your work.
+#
+# This file is part of TEC-controller
+#
+# Please see LICENSE for limitations on use.
+
+# Temperature estimation between EA15 samples. The TEC's voltage is its current
+# times its resistance plus its Seebeck voltage, which is proportional to the
+# difference across it, so every DP832 measurement of V and I is a fast, if
+# indirect, thermometer. A Kalman filter on a lumped thermal model of the bench
+# fuses it with the slow thermocouples, which correct the drift of the model.
+
+import numpy as np
+
+
+class ThermalKF:
+    # States are the cold plate, the load (t1), the heatsink (t2) and ambient, in
+    # C. The model is that of sim.thermal.TECPlant, and the defaults are its
+    # parameters, roughly a TEC1-12706; fit them to the bench for real use. The
+    # current is signed as in the plant, positive cools the plate.
+    #
+    # q is the process noise in C^2/s of each state, ambient being a slow random
+    # walk. r_temp is the variance of an EA15 reading, r_volts of the measured
+    # TEC voltage.
+
+    def __init__(self, ambient=25., seebeck=.05, r=2., k=.5, c_plate=20., c_load=50., c_sink=300., g_plate=1.,
+                 g_load=.2, g_sink=2., q=(1e-3, 1e-4, 1e-4, 1e-6), r_temp=.05 ** 2, r_volts=.01 ** 2, max_dt=.25):
+        self.seebeck = seebeck
+        self.r = r
+        self.k = k
+        self.c_plate = c_plate
+        self.c_load = c_load
+        self.c_sink = c_sink
+        self.g_plate = g_plate
+        self.g_load = g_load
+        self.g_sink = g_sink
+        self.q = np.diag(q)
+        self.r_temp = r_temp
+        self.r_volts = r_volts
+        self.max_dt = max_dt  # Largest step of the discretization, s
+
+        self.x = np.full(4, float(ambient))
+        self.p = np.diag([4., 4., 4., 4.])  # Unknown to a couple of C at the start
+        self.initialized = False
+
+    @property
+    def t1(self):
+        return float(self.x[1])
+
+    @property
+    def t2(self):
+        return float(self.x[2])
+
+    @property
+    def std(self):
+        # Standard deviations of the states
+        return np.sqrt(np.diag(self.p))
+
+    def model(self, i):
+        # dx/dt = a x + b for current i
+        a_ = self.seebeck * i
+        jh = i * i * self.r / 2
+        cp, cl, cs = self.c_plate, self.c_load, self.c_sink
+        a = np.array([[(-self.g_plate - a_ - self.k) / cp, self.g_plate / cp, self.k / cp, 0.],
+                      [self.g_plate / cl, (-self.g_plate - self.g_load) / cl, 0., self.g_load / cl],
+                      [self.k / cs, 0., (a_ - self.k - self.g_sink) / cs, self.g_sink / cs],
+                      [0., 0., 0., 0.]])
+        b = np.array([(-a_ * 273.15 + jh) / cp, 0., (a_ * 273.15 + jh) / cs, 0.])
+        return a, b
+
+    def predict(self, dt, i):
+        # Advances dt seconds with current i applied
+        if dt <= 0:
+            return
+        n = int(np.ceil(dt / self.max_dt))
+        h = dt / n
+        a, b = self.model(i)
+        f = np.eye(4) + a * h
+        for _ in range(n):
+            self.x = f @ self.x + b * h
+            self.p = f @ self.p @ f.T + self.q * h
+
+    def update_(self, h, z, r):
+        y = z - h @ self.x
+        s = h @ self.p @ h + r
+        kk = self.p @ h / s
+        self.x = self.x + kk * y
+        self.p = self.p - np.outer(kk, h @ self.p)
+
+    def update_sample(self, t1, t2):
+        if not self.initialized:
+            # Start from equilibrium at the first reading
+            self.x[:] = [t1, t1, t2, (t1 + t2) / 2]
+            self.initialized = True
+        self.update_(np.array([0., 1., 0., 0.]), t1, self.r_temp)
+        self.update_(np.array([0., 0., 1., 0.]), t2, self.r_temp)
+
+    def update_electrical(self, volts, i):
+        # volts across the TEC with current i, both signed the same way
+        self.update_(np.array([-self.seebeck, 0., self.seebeck, 0.]), volts - i * self.r, self.r_volts)
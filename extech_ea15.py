@@ -15,11 +15,16 @@
 # $ adduser kent dialout
 # $ apt remove modemmanager
 
+import collections
 import datetime
 import multiprocessing as mp
+import queue
 import random
+import struct
 import time
+from multiprocessing import shared_memory
 
+import numpy as np
 import serial
 
 
@@ -71,11 +76,274 @@ class Temperature:
         return v + 273.15
 
 
+class Sample:
+    # A decoded reading. Temperatures are stored in C, Temperature objects and the
+    # datetime are only created when asked for. Pickles as a fixed 36-byte record.
+
+    __slots__ = ('t1c', 't2c', 't1u', 't2u', 'type_code', 'valid', 'mono', 'wall')
+
+    struct_ = struct.Struct('<ddddBBB?')
+
+    def __init__(self):
+        self.t1c = 0.
+        self.t2c = 0.
+        self.t1u = 0
+        self.t2u = 0
+        self.type_code = 0
+        self.valid = False
+        self.mono = 0.  # time.monotonic() when the first byte of the packet arrived
+        self.wall = 0.  # time.time() of the same moment, for logging
+
+    def __str__(self):
+        return f'{self.dt} : {self.t1} : {self.t2} : {self.type} : {self.valid}'
+
+    def __reduce__(self):
+        return Sample.unpack, (self.pack(),)
+
+    def pack(self):
+        return self.struct_.pack(self.t1c, self.t2c, self.mono, self.wall,
+                                 self.t1u, self.t2u, self.type_code, self.valid)
+
+    @classmethod
+    def unpack(cls, b):
+        sample = cls()
+        (sample.t1c, sample.t2c, sample.mono, sample.wall,
+         sample.t1u, sample.t2u, sample.type_code, sample.valid) = cls.struct_.unpack(b)
+        return sample
+
+    @property
+    def t1(self):
+        return Temperature(self.t1c) if self.valid else Temperature()
+
+    @property
+    def t2(self):
+        return Temperature(self.t2c) if self.valid else Temperature()
+
+    @property
+    def type(self):
+        return ExtechEA15Serial.sensor_types.get(self.type_code, '') if self.valid else ''
+
+    @property
+    def dt(self):
+        return datetime.datetime.fromtimestamp(self.wall)
+
+
+class SampleClock:
+    # Estimates the EA15's sample period from the arrival times of its readings
+    # with an alpha-beta filter: the time of the next reading is predicted from the
+    # filtered time of the last one, and the difference to its actual arrival
+    # corrects both a little. Readings skipped by the caller are allowed for by
+    # counting whole periods. The period starts as the shortest of the first
+    # warmup intervals. An arrival further than tolerance periods from its
+    # prediction restarts the filter's phase on it.
+
+    def __init__(self, alpha=.1, beta=.01, tolerance=.5, warmup=4):
+        self.alpha = alpha
+        self.beta = beta
+        self.tolerance = tolerance
+        self.warmup = warmup
+        self.period = None
+        self.t = None  # Filtered arrival time of the last reading
+        self.n = 0  # Intervals seen
+
+    def update(self, mono):
+        # Returns the number of device periods since the previous reading, 0 for the first
+        if self.t is None:
+            self.t = mono
+            return 0
+        interval = mono - self.t
+        self.n += 1
+        if self.n <= self.warmup:
+            self.period = interval if self.period is None else min(self.period, interval)
+            self.t = mono
+            return max(1, round(interval / self.period))
+
+        k = max(1, round(interval / self.period))
+        r = mono - (self.t + k * self.period)
+        if abs(r) > self.tolerance * self.period:
+            self.t = mono
+            return k
+        self.t += k * self.period + self.alpha * r
+        self.period += self.beta * r / k
+        return k
+
+
+class ExtechEA15Framer:
+    # Incrementally splits the serial stream into packets as bytes arrive.
+    # Packet types:
+    #   1: 9-byte reading      02 s1 t1h t1l s2 t2h t2l type 03
+    #   2: 5-byte datalog len  02 00 8c xx 03
+    #   3: part of a datalog dump, 02 00 55 aa 00 ... 03, datalog_expected + 2 bytes
+    #      in all, passed on as it arrives
+    #
+    # Each packet comes with the time.monotonic_ns() its first byte arrived. The
+    # bytes of a read are taken to have arrived back to back at byte_ns apart,
+    # the last of them at the time of the read.
+
+    datalog_marker = b'\x02\x00\x55\xaa\x00'
+
+    byte_ns = 10 * 10 ** 9 // 9600  # Start, 8 data and stop bits at 9600 baud
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.marks = []  # (end offset in buf, arrival of the last byte) of each read
+        self.datalog_expected = 0
+        self.datalog_remaining = 0  # Bytes of the dump in progress not yet passed on
+
+    def reset(self):
+        self.buf.clear()
+        self.marks.clear()
+        self.datalog_remaining = 0
+
+    def arrival(self, i):
+        for end, t_ns in self.marks:
+            if i < end:
+                return t_ns - (end - 1 - i) * self.byte_ns
+        return None
+
+    def feed(self, data, t_ns=None):
+        # Returns the completed packets as (packet type, bytes, first byte arrival).
+        # t_ns is when data was read, default now.
+        self.buf += data
+        self.marks.append((len(self.buf), time.monotonic_ns() if t_ns is None else t_ns))
+
+        frames = []
+        buf = self.buf
+        i = 0
+        n = len(buf)
+        while i < n:
+            if self.datalog_remaining:
+                k = min(self.datalog_remaining, n - i)
+                frames += [(3, bytes(buf[i:i + k]), self.arrival(i))]
+                self.datalog_remaining -= k
+                i += k
+                continue
+
+            if buf[i] != 0x02:
+                j = buf.find(b'\x02', i)
+                if j == -1:
+                    j = n
+                print('Unable to decode:', bytes(buf[i:j]))
+                i = j
+                continue
+
+            m = n - i
+            if m < 5:
+                break
+
+            if buf[i + 1:i + 5] == self.datalog_marker[1:]:
+                if self.datalog_expected > 0:
+                    self.datalog_remaining = self.datalog_expected + 2
+                    self.datalog_expected = 0
+                    continue
+            elif buf[i + 1] == 0x00 and buf[i + 2] >= 0x8c and buf[i + 4] == 0x03:
+                # The length field starts at 0x8c80, far above any temperature a
+                # reading could hold, so this cannot be the start of a 9-byte packet.
+                frames += [(2, bytes(buf[i:i + 5]), self.arrival(i))]
+                i += 5
+                continue
+            else:
+                if m < 9:
+                    break
+                if buf[i + 8] == 0x03:
+                    frames += [(1, bytes(buf[i:i + 9]), self.arrival(i))]
+                    i += 9
+                    continue
+
+            # Not a recognizable packet, resynchronize on the next start byte
+            j = buf.find(b'\x02', i + 1)
+            if j == -1:
+                j = n
+            print('Unable to decode:', bytes(buf[i:j]))
+            i = j
+
+        del buf[:i]
+        self.marks = [(end - i, t_ns) for end, t_ns in self.marks if end > i]
+
+        return frames
+
+
+class DatalogStream:
+    # Incremental decoder of a datalog dump of expected body bytes, the length
+    # reported by the length packet. feed() takes the bytes as they arrive and
+    # returns events for what they complete:
+    #   ('set', set index, seconds per sample)
+    #   ('records', set index, structured array of ExtechEA15Serial.datalog_dtype)
+    #   ('progress', bytes received, bytes in all)
+    # Records are decoded as soon as all 7 of their bytes are in, so a long
+    # download can be used, and shown, while it is still arriving.
+
+    set_marker = b'\x00\x55\xaa\x00'
+
+    def __init__(self, expected):
+        self.total = expected + 2  # The body and the 02 and 03 around it
+        self.received = 0
+        self.pending = bytearray()
+        self.sets = 0
+        self.sps = 0
+        self.records = 0  # In the current set
+        self.records_total = 0
+
+    @property
+    def done(self):
+        return self.received >= self.total
+
+    def feed(self, data):
+        events = []
+        start = self.received
+        self.received += len(data)
+        # Drop the leading 02 and trailing 03
+        lo = max(1 - start, 0)
+        hi = len(data) - max(self.received - (self.total - 1), 0)
+        self.pending += data[lo:hi]
+
+        while True:
+            n = len(self.pending)
+            if n >= 4 and self.pending[:4] == self.set_marker:
+                if n < 5:
+                    break
+                self.sets += 1
+                self.sps = self.pending[4]
+                self.records = 0
+                del self.pending[:5]
+                events += [('set', self.sets - 1, self.sps)]
+                continue
+
+            if self.sets == 0:
+                if n >= 4:
+                    print('Datalog does not start with a set:', bytes(self.pending[:16]))
+                    self.pending.clear()
+                break
+
+            # Whole records up to the next set marker aligned with them
+            k = n // 7
+            if k == 0:
+                break
+            r = np.frombuffer(self.pending, dtype=np.uint8, count=k * 7).reshape(k, 7)
+            m = np.flatnonzero((r[:, 0] == 0x00) & (r[:, 1] == 0x55) & (r[:, 2] == 0xaa) & (r[:, 3] == 0x00))
+            if len(m):
+                k = m[0]
+            arr = ExtechEA15Serial.decode_records(r[:k])
+            arr['offset'] = (self.records + np.arange(k)) * self.sps
+            del r
+            del self.pending[:k * 7]
+            self.records += k
+            self.records_total += k
+            events += [('records', self.sets - 1, arr)]
+
+        if self.done and self.pending:
+            print(f'Truncated download: {len(self.pending)} bytes left over')
+        events += [('progress', min(self.received, self.total), self.total)]
+        return events
+
+
 class ExtechEA15Serial:
     ser = None
     download_datalog_ = False
 
     def __init__(self, dev_fn='', timeformat='datetime'):
+        self.framer = ExtechEA15Framer()
+        self.frames_ = collections.deque()
         self.open(dev_fn)
 
     def __del__(self):
@@ -89,160 +357,184 @@ class ExtechEA15Serial:
         pass
 
     def open(self, dev_fn):
-        # Timeout must be less than the interval between consecutive packets, ~ 1.5s
-        # and not so long that recording the timestamp is delay. 0.1s seems fine.
+        # Packets are framed by their structure, so the timeout only bounds how long
+        # decode_one() blocks waiting for the first byte of a read.
         self.ser = serial.Serial(dev_fn, 9600, timeout=.1)
+        self.framer.reset()
+        self.frames_.clear()
 
-    def decode(self, buf, dt=None):
-        d = {'dt': datetime.datetime.now() if dt is None else dt,
-             't1': Temperature(),
-             't1u': '',
-             't2': '',
-             't2u': '',
-             'type': '',
-             'valid': False
-             }
-
-        d2 = {'dt': d['dt'],
-              't1': Temperature(),
-              't2': Temperature(),
-              'type': '',
-              'valid': False
-              }
+    def decode(self, buf, dt=None, mono=None):
+        # mono is the time.monotonic() the packet arrived, default now
+        sample = Sample()
+        now = time.monotonic()
+        sample.mono = now if mono is None else mono
+        sample.wall = time.time() - (now - sample.mono) if dt is None else dt.timestamp()
 
         if not (buf[0] == 0x02 and buf[-1] == 0x03 and len(buf) == 9):
-            return d2
+            return sample
+
+        t1u = buf[1] & 0x7f
+        t2u = buf[4] & 0x7f
+        if t1u not in self.temp_units or t2u not in self.temp_units or buf[7] not in self.sensor_types:
+            print('Invalid packet:', buf)
+            return sample
+
+        s1 = 1
+        if buf[1] & 0xf0:
+            s1 = -1
+        s2 = 1
+        if buf[4] & 0xf0:
+            s2 = -1
+
+        sample.t1c = self.to_c(s1 * (buf[2] * 0xff + buf[3]) / 10., t1u)
+        sample.t2c = self.to_c(s2 * (buf[5] * 0xff + buf[6]) / 10., t2u)
+        sample.t1u = t1u
+        sample.t2u = t2u
+        sample.type_code = buf[7]
+        sample.valid = True
+
+        return sample
 
-        temp_units = {0: 'C', 2: 'K', 3: 'F'}
-        sensor_types = {0: 'K', 1: 'J', 2: 'E', 3: 'T', 4: 'R', 5: 'S', 6: 'N'}
-
-        try:
-            s1 = 1
-            if buf[1] & 0xf0:
-                s1 = -1
-            s2 = 1
-            if buf[4] & 0xf0:
-                s2 = -1
-
-            d['t1'] = s1 * (buf[2] * 0xff + buf[3]) / 10.
-            d['t1u'] = temp_units[buf[1] & 0x7f]
-            d['t2'] = s2 * (buf[5] * 0xff + buf[6]) / 10.
-            d['t2u'] = temp_units[buf[4] & 0x7f]
-            d['type'] = sensor_types[buf[7]]
-        except KeyError as e:
-            print(e, buf)
-            d['valid'] = False
-        else:
-            d['valid'] = True
-
-        d2 = {'dt': d['dt'],
-              't1': Temperature(d['t1'], d['t1u']),
-              't2': Temperature(d['t2'], d['t2u']),
-              'type': d['type'],
-              'valid': d['valid'],
-              }
+    def decode2(self, buf, start_dt):
+        all_lst = []
+        start_ts = start_dt.timestamp()
+        for sps, arr in self.decode_datalog(buf):
+            lst = []
+            for r in arr:
+                sample = Sample()
+                sample.wall = start_ts + float(r['offset'])
+                if r['valid']:
+                    sample.t1c = float(r['t1'])
+                    sample.t2c = float(r['t2'])
+                    sample.t1u = int(r['t1u'])
+                    sample.t2u = int(r['t2u'])
+                    sample.type_code = int(r['type'])
+                    sample.valid = True
+                lst += [sample]
+            all_lst += [(sps, lst)]
 
-        return d2
+        return all_lst
 
-    def decode2(self, buf, start_dt):
+    temp_units = {0: 'C', 2: 'K', 3: 'F'}
+    sensor_types = {0: 'K', 1: 'J', 2: 'E', 3: 'T', 4: 'R', 5: 'S', 6: 'N'}
+
+    datalog_dtype = np.dtype([('offset', 'f8'),
+                              ('t1', 'f8'),
+                              ('t2', 'f8'),
+                              ('t1u', 'u1'),
+                              ('t2u', 'u1'),
+                              ('type', 'u1'),
+                              ('valid', '?')])
+
+    @classmethod
+    def decode_datalog(cls, buf):
+        # Returns [(sps, records), ...] with one structured array of datalog_dtype per set.
+        # Temperatures are in C, offset is the number of seconds since the first record of the set.
         if not (buf[0] == 0x02 and buf[-1] == 0x03):
             return []
 
-        all_lst = []
+        a = np.frombuffer(buf, dtype=np.uint8)[1:-1]
+        n = len(a)
+
+        # Each set is 00 55 aa 00 followed by the seconds per sample and 7-byte records.
+        # Only markers aligned to a record boundary of the current set start a new set.
+        m = np.flatnonzero((a[:-4] == 0x00) & (a[1:-3] == 0x55) & (a[2:-2] == 0xaa) & (a[3:-1] == 0x00))
+        if len(m) == 0:
+            return []
 
-        i = 1
-        s = 0
-        sps = 0
-        lst = []
-        marker = b'\x00\x55\xaa\x00'
+        spss = []
+        starts = []
+        counts = []
+        p = m[0]
         while True:
-            if s == 0:
-                if len(buf) <= i + 5:
-                    break
-                if buf[i:i + 4] == marker:
-                    s = 1
-                    sps = buf[i + 4]
-                    i += 5
-                else:
-                    i += 1
-            else:
-                if len(buf) <= i + 7:
-                    break
-                if buf[i:i + 4] == marker:
-                    all_lst += [(sps, lst)]
-                    lst = []
-                    sps = buf[i + 4]
-                    i += 5
-                else:
-                    bb = buf[i:i + 7]
-                    bb = b'\x02' + bb + b'\x03'
-                    lst += [self.decode(bb, start_dt + datetime.timedelta(seconds=i * sps))]
-                    i += 7
-
-        if i + 1 != len(buf):
-            print(f'Truncated download: {i + 1} {len(buf)}')
-
-        if lst:
-            all_lst += [(sps, lst)]
+            start = p + 5
+            nxt = m[(m >= start) & ((m - start) % 7 == 0)]
+            end = nxt[0] if len(nxt) else n
+            if (end - start) % 7:
+                print(f'Truncated download: {start + 1 + (end - start) // 7 * 7} {len(buf)}')
+            spss += [int(a[p + 4])]
+            starts += [start]
+            counts += [(end - start) // 7]
+            if not len(nxt):
+                break
+            p = end
+
+        counts = np.array(counts)
+        set_i = np.repeat(np.arange(len(counts)), counts)
+        rec_i = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        rows = np.array(starts)[set_i] + rec_i * 7
+        res = cls.decode_records(a[rows[:, None] + np.arange(7)])
+        res['offset'] = rec_i * np.array(spss)[set_i]
+
+        return [(sps, rr) for sps, rr in zip(spss, np.split(res, np.cumsum(counts)[:-1]))]
+
+    @classmethod
+    def decode_records(cls, r):
+        # Structured array of datalog_dtype from the (n, 7) bytes of n records, offsets left 0
+        r = r.astype(np.int32)
+        res = np.zeros(len(r), dtype=cls.datalog_dtype)
+        res['t1u'] = r[:, 0] & 0x7f
+        res['t2u'] = r[:, 3] & 0x7f
+        res['type'] = r[:, 6]
+        res['t1'] = cls.to_c(np.where(r[:, 0] & 0xf0, -1, 1) * (r[:, 1] * 0xff + r[:, 2]) / 10., res['t1u'])
+        res['t2'] = cls.to_c(np.where(r[:, 3] & 0xf0, -1, 1) * (r[:, 4] * 0xff + r[:, 5]) / 10., res['t2u'])
+        res['valid'] = (np.isin(res['t1u'], list(cls.temp_units)) &
+                        np.isin(res['t2u'], list(cls.temp_units)) &
+                        (res['type'] < len(cls.sensor_types)))
+        return res
 
-        return all_lst
+    @staticmethod
+    def to_c(v, u):
+        # u is a unit code from temp_units, v may be a scalar or an array
+        if np.isscalar(u):
+            return Temperature.k2c(v) if u == 2 else Temperature.f2c(v) if u == 3 else v
+        return np.select([u == 2, u == 3], [Temperature.k2c(v), Temperature.f2c(v)], v)
 
     datalog_download_state_ = 0
     datalog_expected_ = 0
-
-    def decode_one(self):
+    datalog_stream_ = None
+    datalog_requested_ = 0.
+    datalog_discard_until_ = 0.
+    datalog_timeout = 10.  # Seconds to wait for each reply to a download request
+
+    def decode_one(self, timeout=5.):
+        # Returns the next reading, a list of datalog events, or None after timeout
+        # seconds. A download is streamed: while it arrives its DatalogStream
+        # events are returned as they complete, between any live readings, and
+        # the download ends with ('done', sets, records). It ends instead with
+        # ('failed', reason) if the EA15 stops answering for datalog_timeout.
+        st0 = time.time()
         while True:
             if self.download_datalog_ and self.datalog_download_state_ == 0:
                 self.datalog_download_state_ = 1
+                self.datalog_requested_ = time.monotonic()
                 self.download_datalog_ = False
 
-            packet_type = 0
-            buf = b''
-            st0 = time.time()
-            while True:
-                c = self.ser.read()
-                et = time.time()
-
-                # There is a small delay, ~1.5s, between packets. Use the delay to tokenize the
-                # serial stream. When the delay greater than the serial timeout, c will be empty.
-                # If buf is not empty, check if buf may contain a packet.
-                if buf and not c:
-                    if buf[0] == 0x02 and buf[-1] == 0x03:
-                        if buf.startswith(b'\x02\x00\x55\xaa\x00'):
-                            if len(buf) == self.datalog_expected_ + 2:
-                                packet_type = 3
-                        else:
-                            if len(buf) == 9:
-                                packet_type = 1
-                            elif len(buf) == 5:
-                                packet_type = 2
-                    break
+            if (self.datalog_download_state_ and
+                    time.monotonic() - self.datalog_requested_ > self.datalog_timeout):
+                # Nothing at all has arrived for a dump in progress
+                self.framer.datalog_remaining = 0
+                self.abandon_datalog_()
+                return [('failed', 'no reply to download request')]
 
-                # Start over
-                if st0 - et > .5:
-                    print('Restarting')
-                    buf = b''
-                    continue
-                # Don't wait forever
-                elif st0 - et > 5:
-                    print('Aborting')
-                    return None
+            if (self.framer.datalog_expected and self.datalog_stream_ is None and
+                    time.monotonic() > self.datalog_discard_until_):
+                # The dump of an abandoned download never came
+                self.framer.datalog_expected = 0
 
-                buf += c
+            while self.frames_:
+                packet_type, buf, t_ns = self.frames_.popleft()
 
-            if packet_type == 0:
-                print('Unable to decode:', buf)
-            else:
                 if packet_type == 1:
+                    # Requests are sent just after a reading, when the EA15 is listening
                     if self.datalog_download_state_ == 1:
                         self.ser.write(b'\x41')
                         self.ser.flush()
                     elif self.datalog_download_state_ == 2:
                         self.ser.write(b'\x55')
                         self.ser.flush()
-
-                if packet_type == 1:
-                    return self.decode(buf)
+                        self.datalog_download_state_ = 3
+                    return self.decode(buf, mono=t_ns / 1e9)
                 elif packet_type == 2:
                     # print('Datalog len packet:', buf)
                     # 02 00 8c 80 03 <= empty datalog 35968
@@ -251,17 +543,40 @@ class ExtechEA15Serial:
                     # 02 00 8c a1 03 <= 4 datalog entries 36001 33 = 1*5 + 4*7
                     # 02 00 8c c9 03 <= 2 sets with 1 and 8 records 36041 73 = 2*5 + 9*7
                     # 02 00 8d 57 03 <= 30 datalog entries 36183 215 = 1*5 + 30*7
+                    if self.datalog_download_state_ != 1:
+                        continue
                     self.datalog_expected_ = buf[2] * 256 + buf[3] - 0x8c80
                     if self.datalog_expected_ == 0:
-                        print(f'Datalog is empty')
                         self.datalog_download_state_ = 0
-                    else:
-                        print(f'Expecting {self.datalog_expected_} bytes from datalog')
-                        self.datalog_download_state_ = 2
+                        return [('progress', 0, 0), ('done', 0, 0)]
+                    self.datalog_download_state_ = 2
+                    self.datalog_requested_ = time.monotonic()
+                    self.datalog_stream_ = DatalogStream(self.datalog_expected_)
+                    self.framer.datalog_expected = self.datalog_expected_
                 elif packet_type == 3:
-                    self.datalog_download_state_ = 0
-                    self.datalog_expected_ = 0
-                    return self.decode2(buf, datetime.datetime.now())
+                    stream = self.datalog_stream_
+                    if stream is None:
+                        # The rest of a cancelled download
+                        continue
+                    self.datalog_requested_ = time.monotonic()
+                    events = stream.feed(buf)
+                    if stream.done:
+                        events += [('done', stream.sets, stream.records_total)]
+                        self.datalog_stream_ = None
+                        self.datalog_download_state_ = 0
+                        self.datalog_expected_ = 0
+                    return events
+
+            # Don't wait forever
+            if time.time() - st0 > timeout:
+                return None
+
+            # Block for at most the serial timeout waiting for the first byte, then take
+            # whatever else has already arrived in one read. Packets are recognized by
+            # their structure, so there is no need to wait for the gap between packets.
+            c = self.ser.read(max(1, self.ser.in_waiting))
+            if c:
+                self.frames_.extend(self.framer.feed(c, time.monotonic_ns()))
 
     def decode_loop(self):
         while True:
@@ -274,18 +589,160 @@ class ExtechEA15Serial:
         if self.datalog_download_state_ == 0:
             self.download_datalog_ = True
 
+    def cancel_datalog(self):
+        # Returns the events ending the download, if one was in progress. The rest
+        # of a dump the EA15 has started sending is read and discarded.
+        if not self.download_datalog_ and self.datalog_download_state_ == 0:
+            return []
+        received = 0 if self.datalog_stream_ is None else self.datalog_stream_.received
+        self.download_datalog_ = False
+        self.abandon_datalog_()
+        return [('cancelled', received)]
+
+    def abandon_datalog_(self):
+        # Once 0x55 is sent the EA15 may yet send the dump, so the framer goes on
+        # expecting it for datalog_timeout, and it is discarded when it comes.
+        # Forgetting it would take the dump for readings.
+        if self.datalog_download_state_ == 3 and self.framer.datalog_expected:
+            self.datalog_discard_until_ = time.monotonic() + self.datalog_timeout
+        else:
+            self.framer.datalog_expected = 0
+        self.datalog_download_state_ = 0
+        self.datalog_stream_ = None
+        self.datalog_expected_ = 0
+
+    def datalog(self, on_sample=None, timeout=5.):
+        # Generator downloading the datalog, yielding the events of decode_one()
+        # up to and including the last. Readings arriving meanwhile are passed to
+        # on_sample. Closing the generator early cancels the download.
+        self.download_datalog()
+        finished = False
+        try:
+            while True:
+                v = self.decode_one(timeout)
+                if isinstance(v, Sample):
+                    if on_sample is not None:
+                        on_sample(v)
+                elif v is not None:
+                    for e in v:
+                        yield e
+                        if e[0] in ('done', 'failed', 'cancelled'):
+                            finished = True
+                            return
+        finally:
+            if not finished:
+                self.cancel_datalog()
+
+
+class SampleRing:
+    # Single-producer ring of packed Samples in shared memory. Each slot carries the
+    # sequence number of the sample in it and is written seqlock style, so readers
+    # in any number of processes copy samples out without taking a lock; a reader
+    # that falls more than slots behind loses the oldest samples. The lock of cond
+    # is only used to sleep until the producer announces a new sample.
+    #
+    # Layout: 8-byte count of samples written, then slots of 8-byte sequence
+    # number followed by the packed Sample.
+
+    header_ = struct.Struct('<Q')
+    slot_size = 48
+
+    def __init__(self, slots=64):
+        self.slots = slots
+        self.shm = shared_memory.SharedMemory(create=True, size=self.header_.size + slots * self.slot_size)
+        self.shm.buf[:] = bytes(len(self.shm.buf))
+        self.cond = mp.Condition()
+
+    def close(self, unlink=False):
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+    def count(self):
+        return self.header_.unpack_from(self.shm.buf, 0)[0]
+
+    def put(self, sample):
+        n = self.count()
+        off = self.header_.size + (n % self.slots) * self.slot_size
+        buf = self.shm.buf
+        self.header_.pack_into(buf, off, 0)
+        buf[off + 8:off + 8 + Sample.struct_.size] = sample.pack()
+        self.header_.pack_into(buf, off, n + 1)
+        self.header_.pack_into(buf, 0, n + 1)
+        with self.cond:
+            self.cond.notify_all()
+
+    def read(self, i):
+        # Returns sample i, counting from 0, or None if it has been overwritten
+        off = self.header_.size + (i % self.slots) * self.slot_size
+        buf = self.shm.buf
+        s1 = self.header_.unpack_from(buf, off)[0]
+        b = bytes(buf[off + 8:off + 8 + Sample.struct_.size])
+        s2 = self.header_.unpack_from(buf, off)[0]
+        if s1 != i + 1 or s2 != i + 1:
+            return None
+        return Sample.unpack(b)
+
+    def latest(self):
+        while True:
+            n = self.count()
+            if n == 0:
+                return None
+            v = self.read(n - 1)
+            if v is not None:
+                return v
+
+    def wait(self, n, timeout=None):
+        # Blocks until more than n samples have been written, returns False on timeout
+        with self.cond:
+            return self.cond.wait_for(lambda: self.count() > n, timeout)
+
+
+class SampleReader:
+    # One consumer's position in a SampleRing. get() follows mp.Queue.get().
+
+    def __init__(self, ring):
+        self.ring = ring
+        self.n = ring.count()
+        self.overruns = 0  # Samples overwritten before this reader got to them
+
+    def get(self, block=True, timeout=None):
+        while True:
+            n = self.ring.count()
+            if n > self.n:
+                if n - self.n > self.ring.slots:
+                    self.overruns += n - self.n - self.ring.slots
+                    self.n = n - self.ring.slots
+                v = self.ring.read(self.n)
+                if v is None:
+                    continue
+                self.n += 1
+                return v
+
+            if not block or not self.ring.wait(self.n, timeout):
+                raise queue.Empty
+
 
 class ExtechEA15Threaded:
+    # Decodes in a child process. Samples are published through a SampleRing that
+    # any number of processes can read with their own SampleReader; get() reads
+    # through a reader owned by this object. The events of a datalog download
+    # arrive on q2 as they are decoded, read them with datalog().
+
     def __init__(self, dev_fn='', timeformat='datetime'):
-        self.q = mp.Queue()
+        self.ring = SampleRing()
+        self.reader = SampleReader(self.ring)
         self.q2 = mp.Queue()
         self.q3 = mp.Queue()
         self.dev_fn_ = dev_fn
         self.ea15 = ExtechEA15Serial(dev_fn, timeformat=timeformat)
         self.download_datalog_ = False
+        self.p = None
 
     def __del__(self):
-        pass
+        if self.p is not None:
+            self.p.terminate()
+            self.ring.close(unlink=True)
 
     def __enter__(self):
         self.run()
@@ -298,33 +755,68 @@ class ExtechEA15Threaded:
         self.ea15.open(dev_fn)
 
     def run(self):
-        p = mp.Process(target=self.main, args=(self,))
-        p.start()
+        self.p = mp.Process(target=self.main, args=(self,), daemon=True)
+        self.p.start()
 
     def main(self_, self):
         # self.ea15 = ExtechEA15(self.dev_fn_)
         while True:
-            if not self.q3.empty():
-                s = self.q3.get()
+            while True:
+                try:
+                    s = self.q3.get_nowait()
+                except queue.Empty:
+                    break
                 if s == 'Datalog':
                     self.ea15.download_datalog()
+                elif s == 'Cancel':
+                    for e in self.ea15.cancel_datalog():
+                        self.q2.put(e)
 
-            v = self.ea15.decode_one()
+            # A short timeout so commands are picked up promptly between packets
+            v = self.ea15.decode_one(timeout=.1)
             if v is None:
                 pass
-            elif isinstance(v, dict):
-                self.q.put(v)
+            elif isinstance(v, Sample):
+                self.ring.put(v)
             elif isinstance(v, list):
-                self.q2.put(v)
+                for e in v:
+                    self.q2.put(e)
+
+    def get(self, block=True, timeout=None):
+        return self.reader.get(block, timeout)
 
     def download_datalog(self):
         self.q3.put('Datalog')
 
+    def cancel_datalog(self):
+        self.q3.put('Cancel')
+
+    def datalog(self, timeout=None):
+        # Generator downloading the datalog, yielding its events as the decoding
+        # process produces them, up to and including the last. Live samples keep
+        # arriving through get() meanwhile. Raises queue.Empty if no event comes
+        # for timeout seconds. Closing the generator early cancels the download.
+        while True:
+            try:
+                self.q2.get_nowait()  # Left over from an earlier download
+            except queue.Empty:
+                break
+
+        self.download_datalog()
+        finished = False
+        try:
+            while True:
+                e = self.q2.get(timeout=timeout)
+                yield e
+                if e[0] in ('done', 'failed', 'cancelled'):
+                    finished = True
+                    return
+        finally:
+            if not finished:
+                self.cancel_datalog()
 
-def main(dev_fn):
-    def decode(v):
-        return f'{v["dt"]} : {v["t1"]} : {v["t2"]} : {v["type"]} : {v["valid"]}'
 
+def main(dev_fn):
     # Below are a few different ways to use the classes
 
     if False:
@@ -344,35 +836,52 @@ def main(dev_fn):
         ea15 = ExtechEA15Threaded(dev_fn)
         ea15.run()
         while True:
-            while not ea15.q.empty():
-                v = ea15.q.get()
-                print(decode(v))
+            v = ea15.get()
+            print(v)
+
+    if False:
+        # Additional processes can follow the same samples with their own reader
+        def consumer(ring):
+            reader = SampleReader(ring)
+            while True:
+                print('consumer', reader.get())
+
+        ea15 = ExtechEA15Threaded(dev_fn)
+        ea15.run()
+        mp.Process(target=consumer, args=(ea15.ring,)).start()
+        while True:
+            print('main', ea15.ring.latest())
+            time.sleep(1)
 
     if False:
         with ExtechEA15Threaded(dev_fn, timeformat='dt') as ea15:
             while True:
-                while not ea15.q.empty():
-                    v = ea15.q.get()
-                    print(decode(v))
-                # import queue
+                while True:
+                    try:
+                        v = ea15.get(False)
+                    except queue.Empty:
+                        break
+                    print(v)
                 # try:
-                #     v = ea15.q.get(timeout=.05)
+                #     v = ea15.get(timeout=.05)
                 #     print('dequeued', v)
                 # except queue.Empty:
                 #     print('timeout')
 
                 if random.random() < .05:
+                    # Live samples keep arriving through get() during the download
                     print('Requesting datalog download')
-                    ea15.download_datalog()
-
-                while not ea15.q2.empty():
-                    v2_ = ea15.q2.get()
-                    for j, v2 in enumerate(v2_):
-                        sps, lst = v2
-                        print(f'Datalog set {j + 1} with {len(lst)} records, sampled every {sps} seconds')
-                        for i, v in enumerate(lst):
-                            # v['dt'] = i * sps
-                            print(f'{j + 1:02d} : {i + 1:04d} : {decode(v)}')
+                    for e in ea15.datalog(timeout=30.):
+                        if e[0] == 'set':
+                            print(f'Datalog set {e[1] + 1}, sampled every {e[2]} seconds')
+                        elif e[0] == 'records':
+                            for i, v in enumerate(e[2]):
+                                print(f'{e[1] + 1:02d} : {v["offset"]:.0f}s : {v["t1"]:.02f}C : {v["t2"]:.02f}C : '
+                                      f'{ExtechEA15Serial.sensor_types.get(v["type"], "")} : {v["valid"]}')
+                        elif e[0] == 'progress':
+                            print(f'{e[1]} of {e[2]} bytes, latest {ea15.ring.latest()}')
+                        else:
+                            print(e)
 
                 time.sleep(.5)
 
@@ -400,17 +909,20 @@ def main(dev_fn):
         with ExtechEA15Threaded(dev_fn) as ea15:
             t0 = 0
             while True:
-                while not ea15.q.empty():
-                    v = ea15.q.get()
-                    print(decode(v))
-                    if not v['valid']:
+                while True:
+                    try:
+                        v = ea15.get(False)
+                    except queue.Empty:
+                        break
+                    print(v)
+                    if not v.valid:
                         continue
 
-                    y1 += [v['t1'].C()]
-                    y2 += [v['t2'].C()]
+                    y1 += [v.t1c]
+                    y2 += [v.t2c]
                     if x == []:
-                        t0 = v['dt']
-                    x += [(v['dt'] - t0).total_seconds()]
+                        t0 = v.mono
+                    x += [v.mono - t0]
                     line1.set_xdata(x)
                     line1.set_ydata(y1)
                     line2.set_xdata(x)
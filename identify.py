@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Kent A. Vander Velden <kent.vandervelden@gmail.com>
+#
+# If you use this software, please consider contacting me. I'd like to hear
+# about your work.
+#
+# This file is part of TEC-controller
+#
+# Please see LICENSE for limitations on use.
+
+# Online identification of the plant while it is controlled. The model is the
+# one controllers.MPC uses, first order plus dead time with the TEC's static
+# nonlinearity at its input, with the heatsink temperature as a further input:
+#
+#   t1' = phi * t1 + b1 * i + b2 * i^2 + b3 * t2 + c
+#
+# per sample interval, where i and i^2 are averaged over the interval that ended
+# dead time ago. Then tau = -h / ln(phi) for an interval of h seconds, and held
+# long enough a current moves t1 by -gain * i + joule * i^2 with
+# gain = -b1 / (1 - phi) and joule = b2 / (1 - phi).
+#
+# The parameters are fitted by recursive least squares with exponential
+# forgetting, so the model follows the plant as the heatsink warms or the load
+# changes. The dead time is not linear in the model, so one fit runs for each
+# whole number of intervals up to max_delay, all in one batch, and the one with
+# the smallest recent prediction error is taken. The cost per sample is fixed.
+#
+# Held at one temperature in closed loop, the plant is driven only by the
+# noise, and the fit, however small its residual, need not be the plant's. A
+# model is only taken while the fit's data determine phi, and only if it is
+# physically possible, cooling with positive current and heated by its square.
+# While the plant is held, the last model taken is given, marked stale.
+
+import collections
+import math
+
+import numpy as np
+
+
+class PlantRLS:
+    # forget is the forgetting factor per sample, .998 remembers roughly the
+    # last 500. The covariance of each fit is bounded by p_max so it cannot wind
+    # up while the plant is not excited. resolution is that of the readings.
+    # A fit is not updated while it predicts to within half of it, since the
+    # constant readings at steady state carry no information but would forget
+    # what was learnt, and the residual is taken to be at least the rounding
+    # error, so a quiet plant does not look like a perfect fit. min_excitation
+    # is the least RMS variation of t1 over the memory, in C, that the other
+    # inputs do not account for, the excitation needed to tell tau.
+
+    def __init__(self, max_delay=8, forget=.998, p0=1e3, p_max=1e4, resolution=.1, min_samples=50,
+                 min_excitation=1.2):
+        self.forget = forget
+        self.resolution = resolution
+        self.p_max = p_max
+        self.min_samples = min_samples
+        self.min_excitation = min_excitation
+        n = max_delay + 1
+
+        self.theta = np.zeros((n, 5))
+        self.theta[:, 0] = 1.  # Nothing changes until learnt otherwise
+        self.p = np.tile(np.eye(5) * p0, (n, 1, 1))
+        self.err2 = np.zeros(n)  # Mean square prediction error of each fit, forgetting as the fits do
+
+        self.inputs = collections.deque(maxlen=n)  # Mean i and i^2 of the last intervals, newest last
+        self.charge = 0.  # Integrals of i and i^2 over the interval in progress
+        self.charge2 = 0.
+        self.elapsed = 0.
+        self.h = None  # Mean interval, s
+        self.prev = None  # t1 and t2 at the start of the interval in progress
+        self.n = 0
+        self.accepted = None  # Delay, theta, p, err2, h and n of the last fit taken as the model
+
+    def apply(self, i, dt):
+        # Current i was applied for dt seconds
+        self.charge += i * dt
+        self.charge2 += i * i * dt
+        self.elapsed += dt
+
+    def update(self, t1, t2):
+        # A new sample, ending the interval in progress
+        if self.prev is not None and self.elapsed > 0:
+            self.inputs.append((self.charge / self.elapsed, self.charge2 / self.elapsed))
+            self.h = self.elapsed if self.h is None else .99 * self.h + .01 * self.elapsed
+            if len(self.inputs) == self.inputs.maxlen:
+                self.fit(t1)
+                self.accept()
+        self.charge = self.charge2 = self.elapsed = 0.
+        self.prev = (t1, t2)
+
+    def fit(self, t1):
+        # One RLS step for every delay d, whose input is the interval d before the newest
+        u = np.array(self.inputs)[::-1]
+        n = len(u)
+        x = np.column_stack([np.full(n, self.prev[0]), u[:, 0], u[:, 1], np.full(n, self.prev[1]), np.ones(n)])
+
+        e = t1 - (x * self.theta).sum(axis=1)
+        self.err2 = self.forget * self.err2 + (1 - self.forget) * e * e
+        self.n += 1
+
+        m = np.abs(e) > self.resolution / 2
+        if not m.any():
+            return
+        p, x, e = self.p[m], x[m], e[m]
+        px = np.einsum('dij,dj->di', p, x)
+        k = px / (self.forget + (x * px).sum(axis=1))[:, None]
+        self.theta[m] += k * e[:, None]
+        p = (p - k[:, :, None] * px[:, None, :]) / self.forget
+        p = (p + p.transpose(0, 2, 1)) / 2  # Rounding would otherwise lose the symmetry
+        tr = np.trace(p, axis1=1, axis2=2)
+        self.p[m] = p * np.minimum(self.p_max / tr, 1.)[:, None, None]
+
+    @property
+    def delay(self):
+        return int(np.argmin(self.err2))
+
+    def excitation(self, p):
+        # The information on phi beyond the other inputs, as RMS variation of t1 over the memory
+        return math.sqrt((1 - self.forget) / p[0, 0])
+
+    def accept(self):
+        # Takes the best fit as the model if the plant is excited enough to tell
+        # it, and it is stable and physical
+        if self.n < self.min_samples:
+            return
+        d = self.delay
+        if self.excitation(self.p[d]) < self.min_excitation:
+            return
+        phi, b1, b2 = self.theta[d, :3]
+        if not 0 < phi < 1 or -b1 <= 0 or b2 < 0:
+            return
+        self.accepted = (d, self.theta[d].copy(), self.p[d].copy(), self.err2.copy(), self.h, self.n)
+
+    def estimate(self):
+        # The model last taken with standard deviations from its covariance and
+        # residual then, or None if there has not been one. It is stale if the
+        # current fit is not taken, with age the seconds since it last was.
+        # delay_margin is how much worse the next best dead time predicts, near 1
+        # when the data cannot tell them apart.
+        if self.accepted is None:
+            return None
+        d, theta, p, err2, h, n = self.accepted
+        phi, b1, b2, b3, c = theta
+        g = 1 - phi
+
+        residual = math.sqrt(max(err2[d] / (1 - self.forget ** n), self.resolution ** 2 / 12))
+        cov = residual ** 2 * p
+        # Gradients with respect to theta, for the variances by the delta method
+        jac = {'gain': [-b1 / g ** 2, -1 / g, 0, 0, 0],
+               'tau': [h / (phi * math.log(phi) ** 2), 0, 0, 0, 0],
+               'joule': [b2 / g ** 2, 0, 1 / g, 0, 0],
+               'sink': [b3 / g ** 2, 0, 0, 1 / g, 0]}
+        std = {k: math.sqrt(max(np.dot(v, cov @ np.array(v)), 0.)) for k, v in jac.items()}
+
+        others = np.delete(err2, d)
+        return {'gain': -b1 / g, 'gain_std': std['gain'],
+                'tau': -h / math.log(phi), 'tau_std': std['tau'],
+                'joule': b2 / g, 'joule_std': std['joule'],
+                'sink': b3 / g, 'sink_std': std['sink'],
+                'dead_time': d * h, 'interval': h,
+                'residual': residual, 'excitation': self.excitation(p),
+                'delay_margin': float(others.min() / max(err2[d], 1e-30)) if len(others) else float('inf'),
+                'samples': n, 'stale': n < self.n, 'age': (self.n - n) * self.h}
+
+    def summary(self):
+        r = self.estimate()
+        if r is None:
+            return f'Plant model: not identified, {self.n} samples'
+        return (f'Plant model: gain {r["gain"]:.2f}±{r["gain_std"]:.2f} C/A, '
+                f'tau {r["tau"]:.1f}±{r["tau_std"]:.1f} s, dead time {r["dead_time"]:.1f} s, '
+                f'joule {r["joule"]:.3f}±{r["joule_std"]:.3f} C/A^2, sink {r["sink"]:.2f}±{r["sink_std"]:.2f}, '
+                f'residual {r["residual"]:.3f} C over {r["samples"]} samples' +
+                (f', stale, taken {r["age"]:.0f} s ago' if r['stale'] else ''))
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Kent A. Vander Velden <kent.vandervelden@gmail.com>
+#
+# If you use this software, please consider contacting me. I'd like to hear
+# about your work.
+#
+# This file is part of TEC-controller
+#
+# Please see LICENSE for limitations on use.
+
+# Hot-path metrics in the Prometheus text format. Histograms have fixed buckets
+# and observe() is a bisect and three additions, cheap enough for every step.
+# Values already kept elsewhere, such as counters on the controller, are read by
+# callbacks only when scraped. Modules create their metrics at import in the
+# default registry, and serve() exposes it over HTTP.
+
+import bisect
+import http.server
+import threading
+
+# Seconds, 10 us to 10 s
+latency_buckets = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, .01, .025, .05, .1, .25, .5,
+                   1., 2.5, 5., 10.)
+
+
+def format_value(v):
+    if isinstance(v, int):
+        return str(v)
+    if v != v:
+        return 'NaN'
+    if v in (float('inf'), float('-inf')):
+        return '+Inf' if v > 0 else '-Inf'
+    return repr(float(v))
+
+
+class Histogram:
+    def __init__(self, name, help_, buckets=latency_buckets):
+        self.name = name
+        self.help = help_
+        self.bounds = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.bounds) + 1)  # The last is above every bound
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, v):
+        self.counts[bisect.bisect_left(self.bounds, v)] += 1
+        self.sum += v
+        self.count += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        # Copied first so the buckets, sum and count agree with each other
+        counts = list(self.counts)
+        total = 0
+        for bound, c in zip(self.bounds + (float('inf'),), counts):
+            total += c
+            lines.append(f'{self.name}_bucket{{le="{format_value(bound)}"}} {total}')
+        lines.append(f'{self.name}_sum {format_value(self.sum)}')
+        lines.append(f'{self.name}_count {total}')
+        return lines
+
+
+class Callback:
+    # A gauge or counter whose value is read from fn when scraped
+    def __init__(self, name, help_, fn, type_='gauge'):
+        self.name = name
+        self.help = help_
+        self.fn = fn
+        self.type = type_
+
+    def render(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}',
+                f'{self.name} {format_value(self.fn())}']
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def histogram(self, name, help_, buckets=latency_buckets):
+        # Returns the existing histogram of that name, so modules can be reloaded
+        if name not in self.metrics:
+            self.metrics[name] = Histogram(name, help_, buckets)
+        return self.metrics[name]
+
+    def gauge(self, name, help_, fn):
+        # Replaces any earlier callback of that name
+        self.metrics[name] = Callback(name, help_, fn)
+
+    def counter(self, name, help_, fn):
+        self.metrics[name] = Callback(name, help_, fn, 'counter')
+
+    def render(self):
+        lines = []
+        for m in list(self.metrics.values()):
+            try:
+                lines += m.render()
+            except Exception as e:
+                # A failing callback should not take down the whole scrape
+                lines.append(f'# {m.name}: {e!r}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+histogram = registry.histogram
+gauge = registry.gauge
+counter = registry.counter
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    registry = registry
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format_, *args):
+        pass
+
+
+def serve(port=9108, host='127.0.0.1'):
+    # Serves the default registry on /metrics from a daemon thread, returns the server
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Kent A. Vander Velden <kent.vandervelden@gmail.com>
+#
+# If you use this software, please consider contacting me. I'd like to hear
+# about your work.
+#
+# This file is part of TEC-controller
+#
+# Please see LICENSE for limitations on use.
+
+# Offline replay of recorded runs through the controller's PID. The recorded
+# temperatures are fed back unchanged, so the results show what each gain set
+# would have commanded along the recorded trajectory, not how the plant would
+# have responded to it. Resets of the integral term during the run are not replayed.
+#   $ python replay.py runs/run-20200807-120000-001.tecrun
+#   $ python replay.py run.tecrun --kp 1 2 4 --ki .001 .002 --kd 0 .5 --out cf.npz
+
+import argparse
+import itertools
+import time
+
+import numpy as np
+
+import runlog
+import tec_control
+
+
+def load_trace(fn):
+    header, rec = runlog.open_run(fn)
+    return {k: np.asarray(rec[k]) for k in ('t', 'dt', 't1', 'target_temp', 'p_err', 'kp', 'ki', 'kd',
+                                            'term_p', 'term_i', 'term_d', 'pid_i')}
+
+
+def replay(trace, kp, ki, kd, max_i=6., target_temp=None, term_i0=0.):
+    # Evaluates the PID over every step of trace at once. Gains may be scalars,
+    # arrays of per-step values like the recorded ones, or arrays of shape (n, 1)
+    # to evaluate n gain sets, giving results of shape (n, steps).
+    target_rec = trace['target_temp']
+    target = target_rec if target_temp is None else target_temp
+    err = trace['t1'] - target
+    # p_err was recorded against the target of the previous step
+    target_prev = np.r_[target_rec[0], target_rec[:-1]]
+    p_err = trace['p_err'] + target_prev - (target_prev if target_temp is None else target_temp)
+    dt = trace['dt']
+
+    # term_i going into each step, the sum of the increments of the earlier ones
+    inc = np.broadcast_to(ki * dt * err, np.broadcast(kp, ki, kd, err).shape)
+    term_i_prev = term_i0 + np.cumsum(inc, axis=-1) - inc
+
+    term_p, term_i, term_d, pid_i_raw, pid_i = tec_control.pid_step(err, p_err, dt, term_i_prev,
+                                                                    kp, ki, kd, max_i)
+    return {'term_p': term_p, 'term_i': term_i, 'term_d': term_d, 'pid_i_raw': pid_i_raw, 'pid_i': pid_i}
+
+
+def replay_grid(trace, kps, kis, kds, **kwargs):
+    # Every combination of the given gains, returns the (n, 3) gain sets and the results
+    gains = np.array(list(itertools.product(kps, kis, kds)), dtype=float).reshape(-1, 3)
+    return gains, replay(trace, gains[:, 0:1], gains[:, 1:2], gains[:, 2:3], **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recorded run through other PID gains')
+    parser.add_argument('fn', help='run log')
+    parser.add_argument('--kp', type=float, nargs='+', help='default the recorded gains')
+    parser.add_argument('--ki', type=float, nargs='+')
+    parser.add_argument('--kd', type=float, nargs='+')
+    parser.add_argument('--max-i', type=float, default=6.)
+    parser.add_argument('--target', type=float, help='replace the recorded target temperature')
+    parser.add_argument('--out', help='save the counterfactual series to this .npz')
+    args = parser.parse_args()
+
+    trace = load_trace(args.fn)
+    print(f'{args.fn}: {len(trace["t"])} steps, {trace["t"][-1] - trace["t"][0]:.0f} s')
+
+    if args.kp is None and args.ki is None and args.kd is None:
+        # With the recorded gains the replay should reproduce the recorded run
+        st = time.perf_counter()
+        res = replay(trace, trace['kp'], trace['ki'], trace['kd'], args.max_i, args.target)
+        et = time.perf_counter()
+        for k in ('term_p', 'term_i', 'term_d', 'pid_i'):
+            print(f'{k}: max |replay - recorded| {np.abs(res[k] - trace[k]).max():.3g}')
+        gains = np.array([[np.nan] * 3])
+        res = {k: v[None] for k, v in res.items()}
+    else:
+        st = time.perf_counter()
+        gains, res = replay_grid(trace,
+                                 args.kp or [trace['kp'][-1]],
+                                 args.ki or [trace['ki'][-1]],
+                                 args.kd or [trace['kd'][-1]], max_i=args.max_i, target_temp=args.target)
+        et = time.perf_counter()
+        pid_i = res['pid_i']
+        sat = np.mean(np.abs(pid_i) >= args.max_i, axis=1)
+        rms = np.sqrt(np.mean((pid_i - trace['pid_i']) ** 2, axis=1))
+        print(f'{"kp":>8} {"ki":>8} {"kd":>8} {"saturated":>10} {"rms vs recorded":>16}')
+        for g, s, r in zip(gains, sat, rms):
+            print(f'{g[0]:8.4g} {g[1]:8.4g} {g[2]:8.4g} {s * 100:9.1f}% {r:15.4f}A')
+
+    n = res['pid_i'].size
+    print(f'Replayed {n} steps in {et - st:.4f} s ({n / max(et - st, 1e-9):.3g} steps/s)')
+
+    if args.out:
+        np.savez(args.out, gains=gains, t=trace['t'], **res)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Kent A. Vander Velden <kent.vandervelden@gmail.com>
+#
+# If you use this software, please consider contacting me. I'd like to hear
+# about your work.
+#
+# This file is part of TEC-controller
+#
+# Please see LICENSE for limitations on use.
+
+# Binary run logs. A file is a fixed-size header, the magic line followed by JSON
+# describing the channels and padded with spaces, then one little-endian float64
+# record per step with a field per channel. Files can be memory-mapped with
+# open_run() while they are still being written.
+
+import json
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+magic = b'TECRUN1\n'
+header_size = 4096
+
+
+def run_dtype(channels):
+    return np.dtype([(k, '<f8') for k in channels])
+
+
+def open_run(fn):
+    # Returns the header and a read-only memory-mapped structured array of the records
+    with open(fn, 'rb') as f:
+        head = f.read(header_size)
+    if not head.startswith(magic):
+        raise ValueError(f'Not a run log: {fn}')
+    header = json.loads(head[len(magic):].decode())
+    dtype = run_dtype(header['channels'])
+
+    n = (os.path.getsize(fn) - header_size) // dtype.itemsize
+    if n == 0:
+        return header, np.zeros(0, dtype=dtype)
+    return header, np.memmap(fn, dtype=dtype, mode='r', offset=header_size, shape=(n,))
+
+
+class RunRecorder:
+    # Appends records to run logs in path. append() only copies into a batch; full
+    # batches are written by a background thread, which also takes the batch in
+    # progress once flush_interval seconds pass without one, so records reach the
+    # file even when appends stop. A new file is started when the current one reaches
+    # rotate_bytes or is rotate_seconds old. meta is stored in every header.
+
+    def __init__(self, path, channels, batch=64, flush_interval=5., rotate_bytes=256 << 20,
+                 rotate_seconds=24 * 3600, meta=None):
+        self.path = path
+        self.channels = list(channels)
+        self.dtype = run_dtype(self.channels)
+        self.batch_size = batch
+        self.flush_interval = flush_interval
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.meta = {} if meta is None else meta
+
+        self.batch = np.zeros(batch, dtype=self.dtype)
+        self.batch_n = 0
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()  # Over the batch, which the writer thread may take
+
+        self.q = queue.Queue()
+        self.f = None
+        self.fn = None
+        self.opened = 0.
+        self.files = 0
+
+        os.makedirs(path, exist_ok=True)
+        self.thread = threading.Thread(target=self.run, name='RunRecorder', daemon=True)
+        self.thread.start()
+
+    def append(self, values):
+        with self.lock:
+            self.batch[self.batch_n] = tuple(values)
+            self.batch_n += 1
+            if self.batch_n < self.batch_size:
+                return
+            chunk = self.take()
+        self.q.put(chunk)
+
+    def take(self):
+        # The records of the batch in progress, starting a new one. Called holding lock.
+        chunk = self.batch[:self.batch_n]
+        self.batch = np.zeros(self.batch_size, dtype=self.dtype)
+        self.batch_n = 0
+        self.last_flush = time.monotonic()
+        return chunk
+
+    def flush(self):
+        with self.lock:
+            chunk = self.take()
+        if len(chunk):
+            self.q.put(chunk)
+
+    def close(self):
+        self.flush()
+        self.q.put(None)
+        self.thread.join()
+
+    def open_next(self):
+        if self.f is not None:
+            self.f.close()
+
+        self.files += 1
+        self.fn = os.path.join(self.path, time.strftime('run-%Y%m%d-%H%M%S') + f'-{self.files:03d}.tecrun')
+        self.opened = time.monotonic()
+
+        header = dict(self.meta, channels=self.channels, created=time.time())
+        head = magic + json.dumps(header).encode()
+        if len(head) > header_size:
+            raise ValueError('Run log header too large')
+        self.f = open(self.fn, 'wb')
+        self.f.write(head.ljust(header_size, b' '))
+
+    def run(self):
+        while True:
+            try:
+                chunk = self.q.get(timeout=max(self.last_flush + self.flush_interval - time.monotonic(), 0.))
+            except queue.Empty:
+                with self.lock:
+                    chunk = self.take()
+                if not len(chunk):
+                    continue
+            if chunk is None:
+                break
+
+            if (self.f is None or self.f.tell() >= self.rotate_bytes or
+                    time.monotonic() - self.opened >= self.rotate_seconds):
+                self.open_next()
+            self.f.write(chunk.tobytes())
+            self.f.flush()
+
+        if self.f is not None:
+            self.f.close()
@@ -0,0 +1,6 @@
+# Hardware-in-the-loop simulation of the TEC bench: a thermal plant model with
+# stand-ins for the DP832 and the EA15. Run with python -m sim
+
+from sim.fake_dp832 import FakeDP832
+from sim.fake_ea15 import FakeEA15, SimEA15, encode_datalog, encode_reading
+from sim.thermal import TECPlant
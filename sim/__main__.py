@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Kent A. Vander Velden <kent.vandervelden@gmail.com>
+#
+# If you use this software, please consider contacting me. I'd like to hear
+# about your work.
+#
+# This file is part of TEC-controller
+#
+# Please see LICENSE for limitations on use.
+
+# Closed-loop run of TEC_Controller against the simulated bench, from the top of the repo
+#   $ python -m sim --hours 4             As fast as possible
+#   $ python -m sim --hours 1 --speed 60  One simulated minute per second
+#   $ python -m sim --pty --hours .1      Real time through a pty and ExtechEA15Threaded
+#   $ python -m sim --estimator --step .25  Stepping between samples on the estimate of t1
+
+import argparse
+import time
+
+import numpy as np
+
+import archive
+import controllers
+import estimator
+import identify
+import runlog
+import tec_control
+from sim.fake_dp832 import FakeDP832
+from sim.fake_ea15 import FakeEA15, SimEA15
+from sim.thermal import TECPlant
+
+
+def summarize(tec, instr, plant, wall):
+    v = tec.history.view()
+    last = v[0] >= v[0, -1] - 3600
+    err = v[tec.history.rows['err']][last]
+    print(f'Simulated {plant.t / 3600:.2f} h in {wall:.2f} s ({plant.t / max(wall, 1e-9):.0f}x), '
+          f'{tec.history.n} steps, {instr.transactions} instrument transactions')
+    print(f'Final t1:{plant.t_load:.02f}C t2:{plant.t_sink:.02f}C target:{tec.target_temp:.02f}C, '
+          f'last hour rms err:{np.sqrt(np.mean(err ** 2)):.04f}C max |err|:{np.abs(err).max():.04f}C')
+    if tec.identifier is not None:
+        print(tec.identifier.summary())
+
+
+def make_recorder(args):
+    if not args.log_dir:
+        return None
+    return runlog.RunRecorder(args.log_dir, tec_control.TEC_Controller.log_channels,
+                              meta={'sim': True, 'ambient': args.ambient})
+
+
+def make_estimator(args):
+    if not args.estimator:
+        return None
+    return estimator.ThermalKF(ambient=args.ambient)
+
+
+def make_archive(args):
+    if not args.archive_dir:
+        return None
+    return archive.Archive(args.archive_dir, tec_control.TEC_Controller.history_channels)
+
+
+def run_accelerated(args):
+    plant = TECPlant(ambient=args.ambient)
+    instr = FakeDP832(plant)
+    ea15 = SimEA15()
+    tec = tec_control.TEC_Controller(ea15=ea15, instr=instr, verbose=args.verbose, recorder=make_recorder(args),
+                                     clock=lambda: plant.t, estimator=make_estimator(args),
+                                     identifier=identify.PlantRLS() if args.identify else None,
+                                     archive=make_archive(args))
+    tec.setup()
+    if args.mpc:
+        tec.set_controller(controllers.MPC())
+    if args.target is not None:
+        tec.target_temp = args.target
+
+    # Steps every step_period, with a sample every period
+    step_period = args.step or args.period
+    per_sample = max(int(round(args.period / step_period)), 1)
+    st = time.monotonic()
+    for k in range(int(args.hours * 3600 / step_period)):
+        plant.advance(step_period)
+        if k % per_sample == per_sample - 1:
+            ea15.put(plant.t, plant.t_load, plant.t_sink)
+        tec.step()
+
+        if args.speed:
+            time.sleep(max(st + plant.t / args.speed - time.monotonic(), 0))
+
+    tec.shutdown()
+    summarize(tec, instr, plant, time.monotonic() - st)
+
+
+def run_pty(args):
+    # The controller sees wall clock timestamps, so this runs in real time
+    plant = TECPlant(ambient=args.ambient)
+    instr = FakeDP832(plant)
+
+    def read_temps():
+        plant.advance(args.period)
+        return plant.t_load, plant.t_sink
+
+    fake = FakeEA15(read_temps, period=args.period)
+    fake.start()
+
+    tec = tec_control.TEC_Controller(dev_fn=fake.dev_fn, instr=instr, verbose=args.verbose,
+                                     recorder=make_recorder(args), estimator=make_estimator(args),
+                                     identifier=identify.PlantRLS() if args.identify else None,
+                                     archive=make_archive(args))
+    tec.setup()
+    if args.mpc:
+        tec.set_controller(controllers.MPC())
+    if args.target is not None:
+        tec.target_temp = args.target
+    # Steps on each sample, or every --step seconds between them
+    if args.step:
+        worker = tec_control.ControlWorker(tec, period=args.step)
+    else:
+        worker = tec_control.ControlWorker(tec, period=args.period, event_driven=True)
+
+    st = time.monotonic()
+    worker.start()
+    time.sleep(args.hours * 3600)
+    worker.stop()
+    fake.stop()
+    tec.shutdown()
+
+    summarize(tec, instr, plant, time.monotonic() - st)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the TEC controller against a simulated bench')
+    parser.add_argument('--hours', type=float, default=1., help='simulated duration')
+    parser.add_argument('--speed', type=float, default=0., help='simulated seconds per second, 0 for unlimited')
+    parser.add_argument('--period', type=float, default=1.5, help='EA15 sample period, s')
+    parser.add_argument('--ambient', type=float, default=25., help='ambient temperature, C')
+    parser.add_argument('--pty', action='store_true', help='real time through a pty and the EA15 decoder')
+    parser.add_argument('--verbose', action='store_true', help='print every step')
+    parser.add_argument('--log-dir', help='record the run to this directory')
+    parser.add_argument('--archive-dir', help='keep the multi-resolution history in this directory')
+    parser.add_argument('--target', type=float, help='target temperature, default the configured one')
+    parser.add_argument('--estimator', action='store_true', help='control on estimator.ThermalKF\'s t1')
+    parser.add_argument('--identify', action='store_true', help='identify the plant model, printed at the end')
+    parser.add_argument('--step', type=float, help='control period, s, shorter than --period between samples')
+    parser.add_argument('--mpc', action='store_true', help='control with controllers.MPC instead of the PID')
+    args = parser.parse_args()
+
+    if args.pty:
+        run_pty(args)
+    else:
+        run_accelerated(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Kent A. Vander Velden <kent.vandervelden@gmail.com>
+#
+# If you use this software, please consider contacting me. I'd like to hear
+# about your work.
+#
+# This file is part of TEC-controller
+#
+# Please see LICENSE for limitations on use.
+
+
+class FakeDP832:
+    # Stands in for vxi11.Instrument connected to a DP832 wired as on the bench:
+    # CH1 and CH2 in parallel drive the TEC and CH3 powers the relay that reverses
+    # its polarity. Implements the SCPI commands TEC_Controller uses, including
+    # compound messages, and drives the current of a TECPlant.
+
+    idn = 'RIGOL TECHNOLOGIES,DP832,DP8Bxxxxxxxxx,00.01.14'
+
+    relay_i = .07  # Coil current of the polarity relay, A
+
+    def __init__(self, plant):
+        self.plant = plant
+        self.reply = ''
+        self.transactions = 0
+        self.reset()
+
+    def reset(self):
+        self.volt = {1: 0., 2: 0., 3: 0.}
+        self.curr = {1: 0., 2: 0., 3: 0.}
+        self.outp = {1: False, 2: False, 3: False}
+        self.update()
+
+    def tec_current(self):
+        # Total current each channel delivers, limited by the channel's voltage setting
+        i = {ch: self.curr[ch] if self.outp[ch] else 0. for ch in (1, 2)}
+        total = i[1] + i[2]
+        if total > 0:
+            limit = self.plant.max_current(min(self.volt[ch] for ch in (1, 2) if i[ch] > 0))
+            if total > limit:
+                i = {ch: i[ch] * limit / total for ch in i}
+        return i
+
+    def update(self):
+        i = self.tec_current()
+        sign = -1 if self.outp[3] else 1
+        self.plant.i = sign * (i[1] + i[2])
+
+    def measure(self, ch):
+        if ch == 3:
+            i = self.relay_i if self.outp[3] else 0.
+            v = self.volt[3] if self.outp[3] else 0.
+        else:
+            # Settings earlier in the same message have taken effect. The polarity
+            # relay reverses the TEC's terminals, Seebeck voltage included.
+            self.update()
+            i = self.tec_current()[ch]
+            sign = -1 if self.outp[3] else 1
+            v = sign * self.plant.voltage(self.plant.i) if i > 0 else 0.
+        return v, i, v * i
+
+    def write(self, msg):
+        self.transactions += 1
+        self.reply = ';'.join(r for r in (self.command(cmd.strip()) for cmd in msg.split(';')) if r is not None)
+        self.update()
+
+    def read(self):
+        return self.reply
+
+    def ask(self, msg):
+        self.write(msg)
+        return self.read()
+
+    def command(self, cmd):
+        # Returns the reply to a query, or None
+        head, _, arg = cmd.partition(' ')
+        head = head.upper()
+        args = [x.strip().upper() for x in arg.split(',')] if arg else []
+
+        if head == '*IDN?':
+            return self.idn
+        elif head == '*RST':
+            self.reset()
+        elif head == '*CLS':
+            pass
+        elif head == ':APPL':
+            ch = int(args[0][2:])
+            self.volt[ch] = float(args[1])
+            self.curr[ch] = float(args[2])
+        elif head.startswith(':SOUR') and head.endswith(':VOLT'):
+            self.volt[int(head[5])] = float(args[0])
+        elif head.startswith(':SOUR') and head.endswith(':CURR'):
+            self.curr[int(head[5])] = float(args[0])
+        elif head.startswith(':SOUR') and head.endswith(':VOLT?'):
+            return f'{self.volt[int(head[5])]:.3f}'
+        elif head.startswith(':SOUR') and head.endswith(':CURR?'):
+            return f'{self.curr[int(head[5])]:.3f}'
+        elif head == ':OUTP':
+            self.outp[int(args[0][2:])] = args[1] == 'ON'
+        elif head == ':OUTP?':
+            return 'ON' if self.outp[int(args[0][2:])] else 'OFF'
+        elif head == ':MEAS:ALL?':
+            return ','.join(f'{x:.3f}' for x in self.measure(int(args[0][2:])))
+        else:
+            print('FakeDP832: unknown command:', cmd)
+        return None
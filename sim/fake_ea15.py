@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Kent A. Vander Velden <kent.vandervelden@gmail.com>
+#
+# If you use this software, please consider contacting me. I'd like to hear
+# about your work.
+#
+# This file is part of TEC-controller
+#
+# Please see LICENSE for limitations on use.
+
+import os
+import queue
+import select
+import threading
+import time
+import tty
+
+import extech_ea15
+
+
+def encode_temp(t):
+    # Sign/unit byte and the two value bytes, the inverse of ExtechEA15Serial.decode()
+    v = int(round(abs(t) * 10))
+    return [0x80 if t < 0 else 0x00, v // 0xff, v % 0xff]
+
+
+def encode_record(t1, t2, sensor_type=0):
+    return bytes(encode_temp(t1) + encode_temp(t2) + [sensor_type])
+
+
+def encode_reading(t1, t2, sensor_type=0):
+    return b'\x02' + encode_record(t1, t2, sensor_type) + b'\x03'
+
+
+def encode_datalog(sets):
+    # sets is [(sps, [(t1, t2), ...]), ...]. Returns the length packet and the dump.
+    body = b''.join(b'\x00\x55\xaa\x00' + bytes([sps]) + b''.join(encode_record(t1, t2) for t1, t2 in recs)
+                    for sps, recs in sets)
+    n = 0x8c80 + len(body)
+    return bytes([0x02, 0x00, n >> 8, n & 0xff, 0x03]), b'\x02' + body + b'\x03'
+
+
+class FakeEA15:
+    # Pretends to be an EA15 on a pseudo-terminal. dev_fn can be opened by
+    # ExtechEA15Serial. Sends a reading of read_temps() every period seconds and
+    # answers datalog download requests with the contents of datalog. With
+    # dump_rate, the dump is sent at that many bytes per second, as over the
+    # 9600 baud link, and no readings are sent until it is done.
+
+    def __init__(self, read_temps, period=1.5, datalog=(), dump_rate=None):
+        self.read_temps = read_temps
+        self.period = period
+        self.datalog = list(datalog)
+        self.dump_rate = dump_rate
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.dev_fn = os.ttyname(self.slave)
+
+        self.stop_ = threading.Event()
+        self.thread = None
+
+    def close(self):
+        self.stop()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='FakeEA15', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        len_packet, dump = encode_datalog(self.datalog)
+        sending = b''  # Rest of a dump being sent at dump_rate
+        chunk = 64
+
+        deadline = time.monotonic()
+        while not self.stop_.is_set():
+            now = time.monotonic()
+            if now >= deadline:
+                if sending:
+                    os.write(self.master, sending[:chunk])
+                    sending = sending[chunk:]
+                    deadline += chunk / self.dump_rate
+                    if not sending:
+                        deadline = now + self.period
+                else:
+                    os.write(self.master, encode_reading(*self.read_temps()))
+                    deadline += self.period
+                continue
+
+            r, _, _ = select.select([self.master], [], [], deadline - now)
+            if r:
+                for c in os.read(self.master, 64):
+                    if c == 0x41:
+                        os.write(self.master, len_packet)
+                    elif c == 0x55:
+                        if self.dump_rate:
+                            sending = dump
+                            deadline = time.monotonic()
+                        else:
+                            os.write(self.master, dump)
+
+
+class SimEA15:
+    # In-process stand-in for ExtechEA15Threaded whose samples carry simulated
+    # time, for running the loop faster than real time. Controllers reading it
+    # need the simulated clock too. Readings are rounded to the 0.1 C resolution
+    # of the EA15.
+
+    def __init__(self, wall0=None):
+        self.q = queue.Queue()
+        self.wall0 = time.time() if wall0 is None else wall0
+
+    def put(self, t, t1, t2):
+        sample = extech_ea15.Sample()
+        sample.t1c = round(t1, 1)
+        sample.t2c = round(t2, 1)
+        sample.valid = True
+        sample.mono = t
+        sample.wall = self.wall0 + t
+        self.q.put(sample)
+
+    def get(self, block=True, timeout=None):
+        return self.q.get(block, timeout)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Kent A. Vander Velden <kent.vandervelden@gmail.com>
+#
+# If you use this software, please consider contacting me. I'd like to hear
+# about your work.
+#
+# This file is part of TEC-controller
+#
+# Please see LICENSE for limitations on use.
+
+
+class TECPlant:
+    # Lumped thermal model of a TEC between a cold plate carrying the load and a
+    # heatsink. Temperatures are in C, heat capacities in J/K, conductances in W/K.
+    # Positive current pumps heat from the cold plate to the heatsink.
+    #
+    #   ambient -- g_load -- load -- g_plate -- plate -- TEC -- sink -- g_sink -- ambient
+    #
+    # t1 of the EA15 is on the load and t2 on the heatsink.
+
+    def __init__(self, ambient=25.):
+        self.ambient = ambient
+
+        # Roughly a TEC1-12706
+        self.seebeck = .05  # V/K
+        self.r = 2.  # Ohm
+        self.k = .5  # W/K
+
+        self.c_plate = 20.
+        self.c_load = 50.
+        self.c_sink = 300.
+        self.g_plate = 1.
+        self.g_load = .2
+        self.g_sink = 2.
+
+        self.max_dt = .1  # Integration step, s
+
+        self.t = 0.  # Simulated time, s
+        self.t_plate = ambient
+        self.t_load = ambient
+        self.t_sink = ambient
+        self.i = 0.
+
+    def voltage(self, i):
+        return self.seebeck * (self.t_sink - self.t_plate) + i * self.r
+
+    def max_current(self, v):
+        # Largest current a supply limited to v volts can push through the TEC
+        return max((v - self.seebeck * (self.t_sink - self.t_plate)) / self.r, 0.)
+
+    def advance(self, duration, i=None):
+        if i is not None:
+            self.i = i
+        i = self.i
+
+        while duration > 0:
+            dt = min(duration, self.max_dt)
+            duration -= dt
+
+            tc = self.t_plate + 273.15
+            th = self.t_sink + 273.15
+            q_cond = self.k * (self.t_sink - self.t_plate)
+            q_joule = i * i * self.r
+            q_cold = self.seebeck * i * tc - q_joule / 2 - q_cond  # Heat removed from the plate
+            q_hot = self.seebeck * i * th + q_joule / 2 - q_cond  # Heat delivered to the sink
+
+            q_load = self.g_plate * (self.t_load - self.t_plate)
+            self.t_plate += dt * (q_load - q_cold) / self.c_plate
+            self.t_load += dt * (self.g_load * (self.ambient - self.t_load) - q_load) / self.c_load
+            self.t_sink += dt * (q_hot - self.g_sink * (self.t_sink - self.ambient)) / self.c_sink
+            self.t += dt
@@ -0,0 +1,633 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Kent A. Vander Velden <kent.vandervelden@gmail.com>
+#
+# If you use this software, please consider contacting me. I'd like to hear
+# about your work.
+#
+# This file is part of TEC-controller
+#
+# Please see LICENSE for limitations on use.
+
+import queue
+import socket
+import sys
+import threading
+import time
+import traceback
+
+import numpy as np
+
+import dp832
+import extech_ea15
+import metrics
+import telemetry
+
+ps_ip = '192.168.1.144'
+
+step_seconds = metrics.histogram('control_step_seconds', 'Time in TEC_Controller.step, instrument I/O included')
+pid_seconds = metrics.histogram('control_pid_seconds', 'Time computing the PID update')
+sample_age_seconds = metrics.histogram('control_sample_age_seconds',
+                                       'Age of each EA15 sample when the step using it starts')
+sample_backlog = metrics.histogram('control_sample_backlog',
+                                   'Samples queued at each pickup, all but the newest are dropped',
+                                   (0, 1, 2, 4, 8, 16, 32, 64))
+
+
+def pid_step(err, p_err, dt, term_i, kp, ki, kd, max_i):
+    # One update of the PID. Works elementwise on NumPy arrays too, which the
+    # replay uses to evaluate many steps and gain sets at once.
+    term_p = kp * err
+    term_i = term_i + ki * dt * err
+    term_d = kd * (err - p_err) / dt
+    pid_i_raw = term_p + term_i + term_d
+    pid_i = np.clip(pid_i_raw, -max_i, max_i)
+    return term_p, term_i, term_d, pid_i_raw, pid_i
+
+
+class TEC_Controller:
+    # dev_fn and ip select the EA15 and DP832. Alternatively ea15, any object with
+    # ExtechEA15Threaded.get(), and instr, any object with vxi11.Instrument.write()
+    # and ask(), can be passed in, as the simulator does.
+    #
+    # Each step is recorded at full precision by recorder, a runlog.RunRecorder
+    # created with log_channels, if one is given. verbose prints each step.
+    #
+    # set_controller hands the current to another control law from controllers,
+    # such as controllers.MPC, or back to the PID with None. start_tune hands it
+    # to a tuner, such as autotune.RelayTuner, until its experiment is done, and
+    # leaves its result in tune_result. The PID terms are still computed and
+    # logged meanwhile, with the integral held.
+    #
+    # Timing comes from the monotonic arrival times of the samples. The PID's dt is
+    # the number of device periods between the samples used times the period
+    # estimated by an extech_ea15.SampleClock, so arrival jitter and wall clock
+    # steps stay out of term_d. A sample older than max_age_periods periods by
+    # clock, the clock of Sample.mono, is skipped. Wall clock time is only logged,
+    # taken from clock with the offset at the start so it never steps backwards.
+    #
+    # With an estimator, an estimator.ThermalKF, a step needs no new sample. The
+    # PID then acts on the estimate of t1 at the step, from the supply's V and I
+    # measured every step and the samples when they come, so stepping a periodic
+    # ControlWorker faster than the EA15 tightens the loop. dt is then by clock.
+    # t1 and t2 are logged as estimated, t1_meas and t2_meas as last sampled.
+    #
+    # An identifier, an identify.PlantRLS, is given the current applied and each
+    # sample, and keeps a model of the plant learnt while it runs.
+    #
+    # history holds the plotted channels of the recent steps in memory. An
+    # archive, an archive.Archive created with history_channels, keeps them on
+    # disk over weeks and restarts, by wall clock time.
+
+    log_channels = ['mono', 'wall', 't', 'dt',
+                    't1', 't2', 'target_temp', 'err', 'p_err',
+                    'kp', 'ki', 'kd', 'term_p', 'term_i', 'term_d',
+                    'pid_i_raw', 'pid_i', 'target_i', 'total_i', 'total_w',
+                    'delta_t', 'delta_eff',
+                    'v1', 'i1', 'p1', 'v2', 'i2', 'p2', 'v3', 'i3', 'p3',
+                    'dropped', 'duplicate', 'age', 'period', 'stale', 'law',
+                    't1_meas', 't2_meas', 't1_std', 'sample']
+
+    history_channels = ['err', 't1', 't2',
+                        'p', 'i', 'd',
+                        'i_raw', 'i_ps',
+                        'ps1_v', 'ps2_v',
+                        'ps1_i', 'ps2_i']
+
+    def __init__(self, history_capacity=100000, dev_fn=None, ip=ps_ip, ea15=None, instr=None, verbose=False,
+                 recorder=None, clock=time.monotonic, max_age_periods=2., estimator=None,
+                 identifier=None, archive=None):
+        self.config_fn = 'config.txt'
+        self.verbose = verbose
+        self.recorder = recorder
+
+        self.target_temp = 22.5
+        self.kp = 2
+        self.ki = .002
+        self.kd = .5
+
+        self.max_i = 6
+
+        self.history = telemetry.TelemetryRing(self.history_channels, history_capacity)
+
+        self.load_config()
+
+        if ea15 is None:
+            self.dev_fn = dev_fn
+            if self.dev_fn is None:
+                self.dev_fn = extech_ea15.find_dev('usb-Prolific_Technology_Inc._USB-Serial_Controller')
+            if not self.dev_fn:
+                print('No device found')
+            else:
+                print('Using device:', self.dev_fn)
+            #     main2(dev_fn)
+
+            ea15 = extech_ea15.ExtechEA15Threaded(self.dev_fn, timeformat='dt')
+            ea15.run()
+        self.ea15 = ea15
+
+        self.target_i = .5
+
+        self.term_i = 0
+        self.p_err = None
+        self.t0 = None
+        self.st = None
+        self.t0 = None
+        self.total_i = 0
+        self.total_w = 0
+        self.target_i = 0
+
+        self.clock = clock
+        self.wall0 = time.time() - clock()  # Wall clock time of clock's zero
+        self.max_age_periods = max_age_periods
+        self.sample_clock = extech_ea15.SampleClock()
+        self.estimator = estimator
+        self.identifier = identifier
+        self.archive = archive
+        self.applied_i = 0.  # Signed current through the TEC as last measured
+        self.t1_meas = np.nan  # Last EA15 readings
+        self.t2_meas = np.nan
+
+        self.last_mono = None
+        self.samples_dropped = 0  # Stale samples discarded in favor of a newer one
+        self.samples_duplicate = 0  # Samples not newer than the one last used
+        self.samples_stale = 0  # Samples too old to act on when their step started
+        self.samples_invalid = 0  # Samples with no valid reading, such as with a probe unplugged
+
+        self.controller = None
+        self.tuner = None
+        self.tune_result = None
+
+        # Everything shutdown() uses is set by now, as it runs from __del__ even if this exits early
+        self.instr_ok = False
+        self.instr = dp832.DP832(ip, instr=instr)
+        idn = self.instr.ask('*IDN?')
+        print(idn)
+        if not idn.startswith('RIGOL TECHNOLOGIES,DP832'):
+            print('Unknown instrument:', idn)
+            sys.exit(1)
+        self.instr_ok = True
+
+    def __del__(self):
+        self.shutdown()
+
+    def shutdown(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+        if self.archive is not None:
+            self.archive.flush()
+
+        # Leave the supply idle with the outputs off, unless it is not the one expected
+        if self.instr_ok:
+            self.instr.set_current(1, .5)
+            self.instr.set_current(2, .5)
+            self.instr.set_output(1, False)
+            self.instr.set_output(2, False)
+            self.instr.set_output(3, False)
+            self.instr.flush()
+
+    def set_pid(self, target_temp, kp, ki, kd):
+        self.target_temp = target_temp
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+
+        self.save_config()
+
+    def reset_i(self):
+        self.term_i = 0
+
+    def set_controller(self, controller):
+        if controller is not None:
+            controller.reset(self.target_i)
+        # Resume the PID from the current being applied
+        self.term_i = self.target_i
+        self.controller = controller
+
+    def start_tune(self, tuner):
+        if tuner.bias is None:
+            tuner.bias = self.target_i
+        # The integral is held at the bias, so control resumes from the holding current
+        self.term_i = tuner.bias
+        self.tune_result = None
+        self.tuner = tuner
+
+    def save_config(self):
+        with open(self.config_fn, 'w') as f:
+            print(f'{self.target_temp} {self.kp} {self.ki} {self.kd}', file=f)
+
+    def load_config(self):
+        try:
+            cc = [float(x) for x in open(self.config_fn).read().split()]
+            self.target_temp, self.kp, self.ki, self.kd = cc
+        except FileNotFoundError:
+            print(f'Config {self.config_fn} not found, leaving parameters unchanged.')
+
+    def setup(self):
+        self.instr.write('*RST')
+        self.instr.write('*CLS')
+
+        # self.instr.write(':OUTP:TRAC CH2,OFF')
+        # self.instr.write(':OUTP:TRAC CH1,OFF')
+        # print(self.instr.ask(':OUTP:TRAC? CH1'))
+        # print(self.instr.ask(':OUTP:TRAC? CH2'))
+
+        # instr.write(':SYST:ONOFFS OFF')
+
+        self.instr.write(':APPL CH1,12,1')
+        self.instr.write(':APPL CH2,12,1')
+        self.instr.write(':APPL CH3,5,1')
+
+        print(self.instr.ask(':SOUR1:VOLT?'))
+        print(self.instr.ask(':SOUR2:VOLT?'))
+        print(self.instr.ask(':SOUR3:VOLT?'))
+        print(self.instr.ask(':SOUR1:CURR?'))
+        print(self.instr.ask(':SOUR2:CURR?'))
+        print(self.instr.ask(':SOUR3:CURR?'))
+
+        self.instr.set_output(1, True)
+        self.instr.set_output(2, True)
+        self.instr.set_output(3, False)
+        self.instr.flush()
+        print(self.instr.ask(':OUTP? CH1'))
+        print(self.instr.ask(':OUTP? CH2'))
+        print(self.instr.ask(':OUTP? CH3'))
+
+    def next_sample(self, timeout=0):
+        # Returns the newest EA15 sample, waiting up to timeout seconds for one to
+        # arrive, or None. Older queued samples are discarded and counted.
+        try:
+            v = self.ea15.get(timeout is None or timeout > 0, timeout)
+        except queue.Empty:
+            return None
+
+        backlog = 1
+        while True:
+            try:
+                v2 = self.ea15.get(False)
+            except queue.Empty:
+                break
+            self.samples_dropped += 1
+            backlog += 1
+            v = v2
+        sample_backlog.observe(backlog)
+
+        if self.last_mono is not None and v.mono <= self.last_mono:
+            self.samples_duplicate += 1
+            return None
+        self.last_mono = v.mono
+
+        return v
+
+    def step(self, v=None):
+        # With an estimator a step runs with or without a new sample, as often as
+        # it is called, and controls on the estimate of t1 at the time of the step
+        st = time.perf_counter()
+        if v is None:
+            v = self.next_sample()
+        if v is not None and not v.valid:
+            # Its temperatures are meaningless, so it is taken as no sample at all
+            self.samples_invalid += 1
+            print('Invalid EA15 sample:', v)
+            if self.estimator is None or not self.estimator.initialized:
+                return
+            v = None
+        if v is None and (self.estimator is None or not self.estimator.initialized):
+            print('Empty EA15 packet')
+            return
+
+        age = np.nan
+        period = self.sample_clock.period
+        if v is not None:
+            age = self.clock() - v.mono
+            sample_age_seconds.observe(age)
+            self.sample_clock.update(v.mono)
+            period = self.sample_clock.period
+            if period is not None and age > self.max_age_periods * period:
+                self.samples_stale += 1
+                print(f'Stale EA15 sample, {age:.3f}s old')
+                return
+            self.t1_meas = v.t1c
+            self.t2_meas = v.t2c
+
+        # print(v)
+
+        mono = v.mono if self.estimator is None else self.clock()
+        if self.t0 is None:
+            self.t0 = mono
+            self.st = mono
+        t = mono - self.t0
+        dt = mono - self.st
+        if self.identifier is not None:
+            self.identifier.apply(self.applied_i, dt)
+        if self.estimator is not None:
+            self.estimator.predict(dt, self.applied_i)
+        elif period is not None:
+            dt = max(1, round(dt / period)) * period
+
+        ch1_i = self.target_i / 2
+        ch2_i = self.target_i / 2
+
+        # Only changed settings are sent, together with the measurements in one transaction
+        if self.target_i >= 0:
+            self.instr.set_current(1, ch1_i)
+            self.instr.set_current(2, ch2_i)
+            self.instr.set_output(3, False)
+        elif self.target_i < 0:
+            self.instr.set_current(1, -ch1_i)
+            self.instr.set_current(2, -ch2_i)
+            self.instr.set_output(3, True)
+
+        # print('CH1(set):', instr.ask(':SOUR1:CURR?'), ' CH2(set):', instr.ask(':SOUR2:CURR?'))
+
+        ch1_meas, ch2_meas, ch3_meas = self.instr.measure_all([1, 2, 3])
+        self.total_i = ch1_meas[1] + ch2_meas[1]
+        self.total_w = ch1_meas[2] + ch2_meas[2]
+
+        # print(f'CH1: {ch1_meas}  CH2: {ch2_meas}')
+        # print(f'total: {self.total_i:.04} A  {self.total_w:.04} W')
+
+        # print('----')
+
+        # The TEC's current and voltage, reversed with the polarity relay
+        sign = -1 if self.target_i < 0 else 1
+        self.applied_i = sign * self.total_i
+        if self.estimator is not None:
+            if v is not None:
+                self.estimator.update_sample(v.t1c, v.t2c)
+            if abs(self.applied_i) > .05:
+                volts = ch1_meas[0] if ch1_meas[1] > 0 else ch2_meas[0]
+                self.estimator.update_electrical(sign * volts, self.applied_i)
+            t1 = self.estimator.t1
+            t2 = self.estimator.t2
+            t1_std = self.estimator.std[1]
+        else:
+            t1 = v.t1c
+            t2 = v.t2c
+            t1_std = np.nan
+        if self.identifier is not None and v is not None:
+            self.identifier.update(v.t1c, v.t2c)
+
+        err = t1 - self.target_temp
+
+        wall = self.wall0 + mono
+
+        if self.p_err is not None:
+            term_i = self.term_i
+            pid_st = time.perf_counter()
+            term_p, self.term_i, term_d, pid_i_raw, pid_i = pid_step(err, self.p_err, dt, self.term_i,
+                                                                     self.kp, self.ki, self.kd, self.max_i)
+            pid_seconds.observe(time.perf_counter() - pid_st)
+            if self.tuner is not None:
+                self.term_i = term_i
+                pid_i = self.tuner.step(t, err)
+                law = self.tuner.law
+                if self.tuner.done:
+                    self.tune_result = self.tuner.result()
+                    print(self.tuner.summary())
+                    self.tuner = None
+            elif self.controller is not None:
+                self.term_i = term_i
+                pid_i = self.controller.update(t, t1, self.target_temp, dt, self.target_i)
+                law = self.controller.law
+            else:
+                law = 0
+
+            delta_t = abs(t1 - t2)
+            try:
+                delta_eff = delta_t / self.total_w
+            except ZeroDivisionError:
+                delta_eff = float('inf')
+
+            if self.verbose:
+                terms = [f't:{t:.02f}s ',
+                         f'err:{err:.01f}C',
+                         f'term_p:{term_p:.04f}A',
+                         f'term_i:{self.term_i:.04f}A',
+                         f'term_d:{term_d:.04f}A',
+                         f'v1:{ch1_meas[0]:.03f}V',
+                         f'v2:{ch2_meas[0]:.03f}V',
+                         f'v3:{ch3_meas[0]:.03f}V',
+                         f'i1:{ch1_meas[1]:.03f}A',
+                         f'i2:{ch2_meas[1]:.03f}A',
+                         f'i3:{ch3_meas[1]:.03f}A',
+                         f'p1:{ch1_meas[2]:.03f}W',
+                         f'p2:{ch2_meas[2]:.03f}W',
+                         f'p3:{ch3_meas[2]:.03f}W',
+                         f'target:{self.target_temp:.01f}C',
+                         f't1:{t1:.01f}C',
+                         f't2:{t2:.01f}S',
+                         f'delta_t:{delta_t:.01f}C',
+                         f'total_w:{self.total_w:.01f}W',
+                         f'delta_eff:{delta_eff:.01f}C/W',
+                         f'total_i:{self.total_i:.02f}A',
+                         f'target_i:{self.target_i:.02f}A',
+                         f'pid_i_raw:{pid_i_raw:.02f}A',
+                         f'pid_i:{pid_i:.02f}A',
+                         f'ki:{self.ki:.02f}AS/C',
+                         f'kp:{self.kp:.02f}A/C',
+                         f'kd:{self.kd:.02f}A/S',
+                         f'err:{err:.04f}C',
+                         f'p_err:{self.p_err:.04f}C',
+                         f'err-p_err:{err - self.p_err:.04f}C',
+                         f'dt:{dt:.04f}S',
+                         f'(err-p_err)/dt:{(err - self.p_err) / dt:.04f}C/S',
+                         f'dropped:{self.samples_dropped}',
+                         f'duplicate:{self.samples_duplicate}'
+                         ]
+                print(', '.join(terms))
+
+            if self.recorder is not None:
+                self.recorder.append([mono, wall, t, dt,
+                                      t1, t2, self.target_temp, err, self.p_err,
+                                      self.kp, self.ki, self.kd, term_p, self.term_i, term_d,
+                                      pid_i_raw, pid_i, self.target_i, self.total_i, self.total_w,
+                                      delta_t, delta_eff,
+                                      *ch1_meas, *ch2_meas, *ch3_meas,
+                                      self.samples_dropped, self.samples_duplicate,
+                                      age, np.nan if period is None else period, self.samples_stale, law,
+                                      self.t1_meas, self.t2_meas, t1_std, v is not None])
+
+            self.target_i = pid_i
+
+            values = {'err': err,
+                      't1': t1,
+                      't2': t2,
+
+                      'p': term_p,
+                      'i': self.term_i,
+                      'd': term_d,
+
+                      'i_raw': pid_i_raw,
+                      'i_ps': pid_i,
+
+                      'ps1_v': ch1_meas[0],
+                      'ps2_v': ch2_meas[0],
+                      'ps1_i': ch1_meas[1],
+                      'ps2_i': ch2_meas[1]}
+            self.history.append(t, values)
+            if self.archive is not None:
+                self.archive.append(wall, values)
+
+        self.p_err = err
+        self.st = mono
+        step_seconds.observe(time.perf_counter() - st)
+
+
+def register_metrics(tec, worker):
+    # Counters kept by the controller, the worker and the EA15 reader, read when scraped
+    metrics.counter('control_samples_dropped_total', 'Stale EA15 samples discarded for a newer one',
+                    lambda: tec.samples_dropped)
+    metrics.counter('control_samples_duplicate_total', 'EA15 samples not newer than the last used',
+                    lambda: tec.samples_duplicate)
+    metrics.counter('control_samples_stale_total', 'EA15 samples too old to act on', lambda: tec.samples_stale)
+    metrics.counter('control_samples_invalid_total', 'EA15 samples without a valid reading',
+                    lambda: tec.samples_invalid)
+    metrics.gauge('ea15_period_seconds', 'Estimated EA15 sample period',
+                  lambda: tec.sample_clock.period or float('nan'))
+    metrics.counter('control_steps_total', 'Control steps run', lambda: worker.steps)
+    metrics.counter('control_missed_deadlines_total', 'Control periods skipped after an overrun',
+                    lambda: worker.missed)
+    metrics.counter('control_errors_total', 'Control steps that raised', lambda: worker.errors)
+    metrics.gauge('control_max_late_seconds', 'Largest overrun of a control deadline', lambda: worker.max_late)
+    metrics.gauge('control_command_queue_depth', 'Commands waiting for the control thread',
+                  lambda: worker.commands.qsize())
+    if tec.identifier is not None:
+        def model(k):
+            return lambda: (tec.identifier.estimate() or {}).get(k, float('nan'))
+
+        metrics.gauge('plant_gain_c_per_amp', 'Identified steady state cooling per A', model('gain'))
+        metrics.gauge('plant_gain_std_c_per_amp', 'Standard deviation of the identified gain', model('gain_std'))
+        metrics.gauge('plant_tau_seconds', 'Identified time constant', model('tau'))
+        metrics.gauge('plant_tau_std_seconds', 'Standard deviation of the identified time constant',
+                      model('tau_std'))
+        metrics.gauge('plant_dead_time_seconds', 'Identified dead time', model('dead_time'))
+        metrics.gauge('plant_joule_c_per_amp2', 'Identified steady state heating per A^2', model('joule'))
+        metrics.gauge('plant_residual_c', 'RMS one sample prediction error of the identified model',
+                      model('residual'))
+        metrics.gauge('plant_model_age_seconds', 'Time since the identified model was last updated, 0 while current',
+                      model('age'))
+    reader = getattr(tec.ea15, 'reader', None)
+    if reader is not None:
+        metrics.gauge('ea15_ring_backlog', 'Samples published by the EA15 process and not yet read',
+                      lambda: reader.ring.count() - reader.n)
+        metrics.counter('ea15_ring_overruns_total', 'Samples overwritten in the ring before being read',
+                        lambda: reader.overruns)
+        metrics.counter('ea15_samples_total', 'Samples published by the EA15 process',
+                        lambda: reader.ring.count())
+
+
+class ControlWorker:
+    # Runs TEC_Controller.step in its own thread on a fixed period, keeping the
+    # blocking instrument I/O off the GUI thread. Steps are scheduled against
+    # absolute deadlines; when a step overruns, the missed periods are skipped and
+    # counted rather than run back to back. Other threads change the controller only
+    # through commands, which run on the worker thread between steps. Telemetry is
+    # published through tec.history, which has a single writer and needs no lock.
+    #
+    # With event_driven, a step instead runs as soon as each EA15 sample arrives,
+    # and period only bounds how long commands may wait.
+    #
+    # A step that raises is logged and retried on the next period. After
+    # max_failures in a row the error is raised, ending the thread, so whoever
+    # started it can see it is no longer alive and shut the outputs off.
+
+    def __init__(self, tec, period=1., event_driven=False, max_failures=10):
+        self.tec = tec
+        self.period = period
+        self.event_driven = event_driven
+        self.max_failures = max_failures
+        self.commands = queue.Queue()
+        self.stop_ = threading.Event()
+        self.thread = None
+
+        self.steps = 0
+        self.missed = 0
+        self.max_late = 0.
+        self.errors = 0
+        self.failures = 0  # In a row
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='ControlWorker', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def submit(self, fn, *args):
+        self.commands.put((fn, args))
+
+    def set_pid(self, target_temp, kp, ki, kd):
+        self.submit(self.tec.set_pid, target_temp, kp, ki, kd)
+
+    def reset_i(self):
+        self.submit(self.tec.reset_i)
+
+    def clear_history(self):
+        self.submit(self.tec.history.clear)
+
+    def set_controller(self, controller):
+        self.submit(self.tec.set_controller, controller)
+
+    def start_tune(self, tuner):
+        self.submit(self.tec.start_tune, tuner)
+
+    def run_commands(self):
+        while True:
+            try:
+                fn, args = self.commands.get_nowait()
+            except queue.Empty:
+                break
+            fn(*args)
+
+    def run(self):
+        if self.event_driven:
+            self.run_event_driven()
+        else:
+            self.run_periodic()
+
+    def step(self, v=None):
+        try:
+            self.tec.step(v)
+            self.failures = 0
+        except Exception as e:
+            self.errors += 1
+            self.failures += 1
+            if isinstance(e, socket.timeout):
+                print('Instrument timeout:', e)
+            else:
+                print(f'Control step failed: {e!r}')
+                traceback.print_exc()
+            if self.failures >= self.max_failures:
+                print(f'{self.failures} control steps failed in a row, stopping')
+                raise
+        self.steps += 1
+
+    def run_event_driven(self):
+        while not self.stop_.is_set():
+            self.run_commands()
+
+            v = self.tec.next_sample(timeout=self.period)
+            if v is not None:
+                self.step(v)
+
+    def run_periodic(self):
+        deadline = time.monotonic()
+        while not self.stop_.is_set():
+            self.run_commands()
+
+            self.step()
+
+            deadline += self.period
+            now = time.monotonic()
+            late = now - deadline
+            if late > 0:
+                n = int(late // self.period) + 1
+                self.missed += n
+                self.max_late = max(self.max_late, late)
+                deadline += n * self.period
+                print(f'Missed {n} control deadline(s), {late:.3f}s late, {self.missed} total')
+            self.stop_.wait(deadline - time.monotonic())
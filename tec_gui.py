@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Kent A. Vander Velden <kent.vandervelden@gmail.com>
+#
+# If you use this software, please consider contacting me. I'd like to hear
+# about your work.
+#
+# This file is part of TEC-controller
+#
+# Please see LICENSE for limitations on use.
+
+import sys
+import time
+
+import matplotlib
+import numpy as np
+from PyQt5 import QtCore, QtWidgets
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+from matplotlib.figure import Figure
+
+import autotune
+import metrics
+import telemetry
+
+matplotlib.use('Qt5Agg')
+
+frame_seconds = metrics.histogram('gui_frame_seconds', 'Time to update the plots for one frame')
+
+
+class MplCanvas(FigureCanvas):
+    def __init__(self, parent=None, width=5, height=4, dpi=100, blit=True):
+        fig = Figure(figsize=(width, height), dpi=dpi)
+        axs_ = fig.subplots(4, 3, sharex='all')
+        super(MplCanvas, self).__init__(fig)
+
+        self.axs = {'err': axs_[0][0],
+                    't1': axs_[0][1],
+                    't2': axs_[0][2],
+
+                    'p': axs_[1][0],
+                    'i': axs_[1][1],
+                    'd': axs_[1][2],
+
+                    'i_raw': axs_[2][0],
+                    'i_ps': axs_[2][1],
+                    'ps1_v': axs_[2][2],
+
+                    'ps1_i': axs_[3][0],
+                    'ps2_i': axs_[3][1],
+                    'ps2_v': axs_[3][2]
+                    }
+
+        self.x = []
+        self.ys = {k: [] for k in self.axs}
+
+        # With blitting, the lines are animated and left out of full draws. They are drawn
+        # over a cached copy of the axes by on_draw() and blit_lines().
+        self.blit_ = blit and self.supports_blit
+        self.lines = {k: self.axs[k].plot(self.x, self.ys[k], 'r-', label=k, animated=self.blit_)[0] for k in self.axs}
+
+        self.background = None
+        self.decimator = None
+        self.history_state = None  # (generation, n) of the history last shown
+        self.stale_ = True
+        self.mpl_connect('draw_event', self.on_draw)
+
+        self.axs['err'].set_ylabel(r'err [$\mathregular{\degree C}$]')
+        self.axs['t1'].set_ylabel(r't1 [$\mathregular{\degree C}$]')
+        self.axs['t2'].set_ylabel(r't2 [$\mathregular{\degree C}$]')
+
+        self.axs['p'].set_ylabel(r'p [$\mathregular{A\ \degree C^{-1}}$]')
+        self.axs['i'].set_ylabel(r'i [$\mathregular{A\ \degree C^{-1}\ s^{-1}}$]')
+        self.axs['d'].set_ylabel(r'd [$\mathregular{A\ s\ \degree C^{-1}}$]')
+
+        self.axs['i_raw'].set_ylabel('I_raw [A]')
+        self.axs['i_ps'].set_ylabel('I_ps [A]')
+
+        self.axs['ps1_v'].set_ylabel('ps1_V [V]')
+        self.axs['ps2_v'].set_ylabel('ps2_V [V]')
+        self.axs['ps1_i'].set_ylabel('ps1_I [A]')
+        self.axs['ps2_i'].set_ylabel('ps2_I [A]')
+
+        self.target_line = self.axs['t1'].axhline(0)
+
+        # To create a common x-label, overlay an empty graph over the sub-graphs
+        a = fig.add_subplot(111, frameon=False)
+        a.set_xlabel("Time [s]")
+        a.tick_params(labelcolor='none', top=False, bottom=False, left=False, right=False)
+
+    def set_target(self, target_temp):
+        self.target_line.set_ydata([target_temp, target_temp])
+        self.stale_ = True
+
+    def on_draw(self, event):
+        if self.blit_:
+            self.background = self.copy_from_bbox(self.figure.bbox)
+            self.draw_lines()
+
+    def draw_lines(self):
+        for line in self.lines.values():
+            self.figure.draw_artist(line)
+
+    def blit_lines(self):
+        self.restore_region(self.background)
+        self.draw_lines()
+        self.blit(self.figure.bbox)
+
+    @staticmethod
+    def data_range(a, pad=0.):
+        a = a[np.isfinite(a)]
+        if not len(a):
+            return None
+        lo, hi = a.min(), a.max()
+        pad = (hi - lo) * pad if hi > lo else pad * 5
+        return lo - pad, hi + pad
+
+    def update_history(self, history):
+        # Redraws only if samples were added since the last call. Axis limits are
+        # recomputed, and the whole figure drawn, only when new samples fall outside
+        # the current view; otherwise the lines are blitted over the cached background.
+        state = (history.generation, history.n)
+        if state == self.history_state and not self.stale_:
+            return
+
+        v = history.view(n=state[1])
+        full = self.stale_ or self.background is None or not self.blit_
+        if self.history_state is None or self.history_state[0] != history.generation:
+            new = v
+            full = True
+        else:
+            new = v[:, max(0, v.shape[1] - (state[1] - self.history_state[1])):]
+        self.history_state = state
+        self.stale_ = False
+
+        if new.shape[1]:
+            ax0 = self.axs['err']
+            x0, x1 = ax0.get_xlim()
+            if new is v or new[0, 0] < x0 or new[0, -1] > x1:
+                # Leave headroom so the next few samples fit without a full redraw
+                span = v[0, -1] - v[0, 0]
+                ax0.set_xlim(v[0, 0], v[0, -1] + max(span * .25, 60.))
+                full = True
+
+            for k, i in history.rows.items():
+                ax = self.axs[k]
+                r = self.data_range(new[i])
+                if r is None:
+                    continue
+                y0, y1 = ax.get_ylim()
+                if new is v or r[0] < y0 or r[1] > y1:
+                    ax.set_ylim(self.data_range(v[i], .1))
+                    full = True
+
+        # Lines are fed at most two points per pixel, however long the history
+        if self.decimator is None or self.decimator.history is not history:
+            self.decimator = telemetry.MinMaxDecimator(history)
+        x0, x1 = self.axs['err'].get_xlim()
+        dv = self.decimator.view(x0, x1, max(int(self.axs['err'].bbox.width), 1))
+        for k, i in history.rows.items():
+            self.lines[k].set_data(dv[0], dv[i])
+
+        if full:
+            self.draw()
+        else:
+            self.blit_lines()
+        self.flush_events()
+
+    def show_archive(self, archive, x0, x1):
+        # Plots an archive.Archive over wall clock times [x0, x1], in seconds before
+        # x1, from the level that has about two points per pixel
+        v = archive.view(x0, x1, max(int(self.axs['err'].bbox.width), 1))
+        self.axs['err'].set_xlim(x0 - x1, 0)
+        for k, i in archive.rows.items():
+            self.lines[k].set_data(v[0] - x1, v[i])
+            r = self.data_range(v[i], .1)
+            if r is not None:
+                self.axs[k].set_ylim(r)
+
+        # A later update_history() starts over
+        self.history_state = None
+        self.stale_ = True
+        self.draw()
+        self.flush_events()
+
+
+class TEC_Window(QtWidgets.QMainWindow):
+    # Viewer and gain editor for a TEC_Controller run by a ControlWorker
+
+    def __init__(self, tec, worker, *args, **kwargs):
+        self.tec = tec
+        self.worker = worker
+
+        super().__init__(*args, **kwargs)
+        self._main = QtWidgets.QWidget()
+        self.setCentralWidget(self._main)
+        layout = QtWidgets.QHBoxLayout(self._main)
+
+        self.canvas = MplCanvas(self, width=5, height=4, dpi=100)
+        layout.addWidget(self.canvas)
+
+        self.xdata = []
+        self.ydata = []
+
+        self.canvas.set_target(self.tec.target_temp)
+
+        layout2 = QtWidgets.QVBoxLayout()
+        layout.addLayout(layout2)
+
+        self.inputs = {}
+
+        def aa(vn, s, v):
+            layout3 = QtWidgets.QHBoxLayout()
+
+            label = QtWidgets.QLabel(s, self)
+            label.setFixedWidth(120)
+            layout3.addWidget(label)
+            self.inputs[vn] = QtWidgets.QLineEdit(v, self)
+            self.inputs[vn].setFixedWidth(100)
+            layout3.addWidget(self.inputs[vn])
+            # button.clicked.connect(lambda: self.clear_graph())
+
+            return layout3
+
+        layout2.addLayout(aa('target_temp', 'Target temp [C]', str(self.tec.target_temp)))
+        layout2.addLayout(aa('Kp', 'Kp [A]/[C]', str(self.tec.kp)))
+        layout2.addLayout(aa('Ki', 'Ki [A]/([C][s])', str(self.tec.ki)))
+        layout2.addLayout(aa('Kd', 'Kd [A][s]/[C]', str(self.tec.kd)))
+
+        button = QtWidgets.QPushButton('Set PID', self)
+        layout2.addWidget(button)
+        button.clicked.connect(lambda: self.set_pid())
+        button.setFixedSize(button.sizeHint())
+
+        button = QtWidgets.QPushButton('Reset I_term', self)
+        layout2.addWidget(button)
+        button.clicked.connect(lambda: self.reset_i())
+        button.setFixedSize(button.sizeHint())
+
+        button = QtWidgets.QPushButton('Clear graph', self)
+        layout2.addWidget(button)
+        button.clicked.connect(lambda: self.clear_graph())
+        button.setFixedSize(button.sizeHint())
+
+        button = QtWidgets.QPushButton('Relay tune', self)
+        layout2.addWidget(button)
+        button.clicked.connect(lambda: self.relay_tune())
+        button.setFixedSize(button.sizeHint())
+        self.tune_result = None
+
+        # self.update_plot()
+
+        # Setup a timer to trigger the redraw by calling update_plot.
+        self.timer2 = QtCore.QTimer()
+        self.timer2.setInterval(100)
+        self.timer2.timeout.connect(self.update_plot)
+        self.timer2.start()
+
+        self.resize(1920, 1080)
+        self.show()
+
+    def clear_graph(self):
+        self.worker.clear_history()
+
+    def set_pid(self):
+        target_temp = float(self.inputs['target_temp'].text())
+        self.worker.set_pid(target_temp,
+                            float(self.inputs['Kp'].text()),
+                            float(self.inputs['Ki'].text()),
+                            float(self.inputs['Kd'].text()))
+
+        self.canvas.set_target(target_temp)
+
+    def reset_i(self):
+        self.worker.reset_i()
+
+    def relay_tune(self):
+        self.worker.start_tune(autotune.RelayTuner())
+
+    def update_plot(self):
+        # Closing the window ends the app, whose caller then turns the outputs off
+        if not self.worker.thread.is_alive():
+            print('Control thread stopped, closing the window')
+            self.timer2.stop()
+            self.close()
+            return
+
+        st = time.perf_counter()
+        self.canvas.update_history(self.tec.history)
+        frame_seconds.observe(time.perf_counter() - st)
+
+        # The best gains of a finished tune are filled in, to be applied with Set PID
+        res = self.tec.tune_result
+        if res is not self.tune_result:
+            self.tune_result = res
+            if res is not None:
+                self.statusBar().showMessage(autotune.format_result(res))
+            if res is not None and 'ranked' in res:
+                best = res['ranked'][0]
+                self.inputs['Kp'].setText(f'{best["kp"]:.4g}')
+                self.inputs['Ki'].setText(f'{best["ki"]:.4g}')
+                self.inputs['Kd'].setText(f'{best["kd"]:.4g}')
+
+
+def main(tec, worker):
+    app = QtWidgets.QApplication(sys.argv[:1])
+    w = TEC_Window(tec, worker)
+    app.exec_()
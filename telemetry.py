@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Kent A. Vander Velden <kent.vandervelden@gmail.com>
+#
+# If you use this software, please consider contacting me. I'd like to hear
+# about your work.
+#
+# This file is part of TEC-controller
+#
+# Please see LICENSE for limitations on use.
+
+import collections
+
+import numpy as np
+
+
+class TelemetryRing:
+    # Fixed-memory history of telemetry channels held in one columnar block, row 0 is
+    # time and row i + 1 is channels[i]. Each sample is written twice, capacity
+    # columns apart, so the most recent capacity samples are always contiguous and
+    # readers are handed views instead of copies.
+
+    def __init__(self, channels, capacity=100000):
+        self.channels = list(channels)
+        self.capacity = capacity
+        self.rows = {k: i + 1 for i, k in enumerate(self.channels)}
+        self.data = np.zeros((len(self.channels) + 1, 2 * capacity))
+        self.n = 0  # Total samples appended since the last clear
+        self.generation = 0  # Incremented by clear(), so readers can tell n restarted
+
+    def __len__(self):
+        return min(self.n, self.capacity)
+
+    def __getitem__(self, k):
+        return self.view()[self.rows[k]]
+
+    def clear(self):
+        self.n = 0
+        self.generation += 1
+
+    def append(self, t, values):
+        i = self.n % self.capacity
+        col = [t] + [values[k] for k in self.channels]
+        self.data[:, i] = col
+        self.data[:, i + self.capacity] = col
+        self.n += 1
+
+    def view(self, seconds=None, n=None):
+        # Returns a (channels + 1, n) view of the retained history, optionally
+        # limited to the last seconds of it. Times must be non-decreasing.
+        # append() fills in a column before publishing it by incrementing n, so a
+        # reader in another thread reads n once and passes it along to get a
+        # consistent snapshot.
+        if n is None:
+            n = self.n
+        end = n if n <= self.capacity else n % self.capacity + self.capacity
+        v = self.data[:, end - min(n, self.capacity):end]
+        if seconds is not None and v.shape[1]:
+            v = v[:, np.searchsorted(v[0], v[0, -1] - seconds):]
+        return v
+
+    def t(self, seconds=None):
+        return self.view(seconds)[0]
+
+    def last(self):
+        if not self.n:
+            return None
+        col = self.view()[:, -1]
+        return {'t': col[0], **{k: col[self.rows[k]] for k in self.channels}}
+
+
+class DecimationLevel:
+    # Per-bucket minimum and maximum of every row of a TelemetryRing for buckets w
+    # seconds wide. update() only folds in the samples added since the last call.
+
+    def __init__(self, w, rows):
+        self.w = w
+        self.n = 0  # history.n already folded in
+        self.b = np.zeros(0, dtype=np.int64)
+        self.lo = np.zeros((rows, 0))
+        self.hi = np.zeros((rows, 0))
+
+    def update(self, history):
+        n = history.n
+        v = history.view(n=n)
+        k = min(n - self.n, v.shape[1])
+        self.n = n
+        if k > 0:
+            new = v[:, -k:]
+            b = np.floor(new[0] / self.w).astype(np.int64)
+            starts = np.flatnonzero(np.r_[True, b[1:] != b[:-1]])
+            lo = np.minimum.reduceat(new, starts, axis=1)
+            hi = np.maximum.reduceat(new, starts, axis=1)
+            b = b[starts]
+
+            if len(self.b) and self.b[-1] == b[0]:
+                self.lo[:, -1] = np.minimum(self.lo[:, -1], lo[:, 0])
+                self.hi[:, -1] = np.maximum(self.hi[:, -1], hi[:, 0])
+                b, lo, hi = b[1:], lo[:, 1:], hi[:, 1:]
+
+            self.b = np.concatenate([self.b, b])
+            self.lo = np.concatenate([self.lo, lo], axis=1)
+            self.hi = np.concatenate([self.hi, hi], axis=1)
+
+        # Forget buckets whose samples have all left the history
+        if len(self.b) and v.shape[1]:
+            i = np.searchsorted(self.b, np.floor(v[0, 0] / self.w))
+            if i:
+                self.b, self.lo, self.hi = self.b[i:], self.lo[:, i:], self.hi[:, i:]
+
+    def points(self, x0, x1):
+        # Two columns per bucket, the minimum of each row followed by the maximum.
+        # Row 0 is time, so each point sits at the earliest or latest time in its bucket.
+        i0, i1 = np.searchsorted(self.b, [np.floor(x0 / self.w), np.floor(x1 / self.w)])
+        i0 = max(i0 - 1, 0)
+        i1 = min(i1 + 1, len(self.b))
+        out = np.empty((self.lo.shape[0], 2 * (i1 - i0)))
+        out[:, 0::2] = self.lo[:, i0:i1]
+        out[:, 1::2] = self.hi[:, i0:i1]
+        return out
+
+
+class MinMaxDecimator:
+    # Reduces a TelemetryRing to at most two points, the minimum and maximum, per
+    # horizontal pixel so drawing cost does not grow with the length of the run.
+    # Bucket widths are powers of two seconds and the most recently used zoom
+    # levels are cached and kept up to date incrementally.
+
+    def __init__(self, history, max_levels=4):
+        self.history = history
+        self.max_levels = max_levels
+        self.levels = collections.OrderedDict()
+        self.generation = history.generation
+
+    def view(self, x0, x1, pixels):
+        # Returns a (channels + 1, m) array covering [x0, x1] like TelemetryRing.view()
+        h = self.history
+        if h.generation != self.generation:
+            self.levels.clear()
+            self.generation = h.generation
+
+        v = h.view()
+        i0, i1 = np.searchsorted(v[0], [x0, x1])
+        if i1 - i0 <= 2 * pixels:
+            return v[:, max(i0 - 1, 0):i1 + 1]
+
+        level = int(np.ceil(np.log2((x1 - x0) / pixels)))
+        lv = self.levels.pop(level, None)
+        if lv is None:
+            lv = DecimationLevel(2. ** level, v.shape[0])
+        self.levels[level] = lv
+        while len(self.levels) > self.max_levels:
+            self.levels.popitem(last=False)
+
+        lv.update(h)
+        return lv.points(x0, x1)
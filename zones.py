@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Kent A. Vander Velden <kent.vandervelden@gmail.com>
+#
+# If you use this software, please consider contacting me. I'd like to hear
+# about your work.
+#
+# This file is part of TEC-controller
+#
+# Please see LICENSE for limitations on use.
+
+# Many TEC zones across several DP832 supplies and EA15 thermometers in one
+# process. A zone is one PID loop from one thermometer input to a group of supply
+# channels. The zones file, JSON, allocates them:
+#
+#   {"supplies": {"ps1": "192.168.1.144", "ps2": "192.168.1.145"},
+#    "thermometers": {"ea1": "/dev/serial/by-id/usb-Prolific_...-port0"},
+#    "zones": [{"name": "a", "sensor": ["ea1", "t1"], "supply": "ps1", "channels": [1, 2], "polarity": 3,
+#               "target_temp": 22.5, "kp": 2, "ki": 0.002, "kd": 0.5},
+#              {"name": "b", "sensor": ["ea1", "t2"], "supply": "ps2", "channels": [1]}]}
+#
+# The current of a zone is split evenly across its channels. polarity, if given,
+# is the channel switching the relay that reverses the TEC for negative current;
+# without one the current is limited to zero and above. max_i and volts are
+# optional, the limits of the whole zone and of each channel.
+#
+#   $ python zones.py zones.json            Control headless, stop with SIGINT or SIGTERM
+
+import argparse
+import concurrent.futures
+import json
+import queue
+import signal
+import threading
+
+import dp832
+import extech_ea15
+import tec_control
+import telemetry
+
+
+class Zone:
+    def __init__(self, name, sensor, supply, channels, polarity=None, target_temp=22.5, kp=2, ki=.002, kd=.5,
+                 max_i=6, volts=12., history_capacity=100000):
+        self.name = name
+        self.thermometer, self.input = sensor
+        self.supply = supply
+        self.channels = list(channels)
+        self.polarity = polarity
+        self.target_temp = target_temp
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.max_i = max_i
+        self.volts = volts
+
+        self.term_i = 0
+        self.p_err = None
+        self.st = None
+        self.t0 = None
+        self.target_i = 0
+        self.pending = None  # History values of the last update, completed by record()
+
+        self.history = telemetry.TelemetryRing(['err', 't', 'p', 'i', 'd', 'i_raw', 'i_ps', 'v', 'i_meas', 'w'],
+                                               history_capacity)
+
+    def config(self):
+        return {'name': self.name, 'sensor': [self.thermometer, self.input], 'supply': self.supply,
+                'channels': self.channels, 'polarity': self.polarity, 'target_temp': self.target_temp,
+                'kp': self.kp, 'ki': self.ki, 'kd': self.kd, 'max_i': self.max_i, 'volts': self.volts}
+
+    def allocated(self):
+        return self.channels + ([self.polarity] if self.polarity is not None else [])
+
+    def setup(self, instr):
+        for ch in self.channels:
+            instr.write(f':APPL CH{ch},{self.volts},1')
+            instr.set_output(ch, True)
+        if self.polarity is not None:
+            instr.write(f':APPL CH{self.polarity},5,1')
+            instr.set_output(self.polarity, False)
+
+    def update(self, v, period=None):
+        # PID step on a new sample, setting target_i for the next apply(). dt is
+        # whole periods of the thermometer when its period is known, as in
+        # TEC_Controller.step. A sample without a valid reading is ignored, and
+        # the next one's dt spans it.
+        if not v.valid:
+            return
+        temp = getattr(v, self.input + 'c')
+        if self.t0 is None:
+            self.t0 = v.mono
+            self.st = v.mono
+        t = v.mono - self.t0
+        dt = v.mono - self.st
+        if period is not None:
+            dt = max(1, round(dt / period)) * period
+        err = temp - self.target_temp
+
+        if self.p_err is not None:
+            term_p, self.term_i, term_d, pid_i_raw, pid_i = tec_control.pid_step(err, self.p_err, dt, self.term_i,
+                                                                                 self.kp, self.ki, self.kd,
+                                                                                 self.max_i)
+            if self.polarity is None:
+                pid_i = max(pid_i, 0.)
+            self.target_i = pid_i
+            self.pending = (t, {'err': err, 't': temp, 'p': term_p, 'i': self.term_i, 'd': term_d,
+                                'i_raw': pid_i_raw, 'i_ps': pid_i})
+
+        self.p_err = err
+        self.st = v.mono
+
+    def apply(self, instr):
+        i = abs(self.target_i) / len(self.channels)
+        for ch in self.channels:
+            instr.set_current(ch, i)
+        if self.polarity is not None:
+            instr.set_output(self.polarity, self.target_i < 0)
+
+    def record(self, meas):
+        # meas maps channel to [volts, amps, watts] measured after apply
+        if self.pending is None:
+            return
+        t, values = self.pending
+        self.pending = None
+        values['v'] = max(meas[ch][0] for ch in self.channels)
+        values['i_meas'] = sum(meas[ch][1] for ch in self.channels)
+        values['w'] = sum(meas[ch][2] for ch in self.channels)
+        self.history.append(t, values)
+
+
+class MultiZoneController:
+    # Drives the zones of a zones file. There is one DP832, so one VXI-11 link,
+    # per supply, shared by its zones. A step takes the newest sample of each
+    # thermometer, runs the PID of each zone with a new sample, then for each
+    # supply sends its zones' settings and measurement queries as one compound
+    # transaction. The supplies are served concurrently by a thread each, so a
+    # step takes about as long as the slowest supply rather than the sum of them.
+    #
+    # instrs and thermometers map names to objects to use instead of connecting,
+    # as for TEC_Controller. It has the interface ControlWorker uses.
+
+    def __init__(self, config_fn, instrs=None, thermometers=None, history_capacity=100000):
+        self.config_fn = config_fn
+        with open(config_fn) as f:
+            config = json.load(f)
+        self.supply_ips = config['supplies']
+        self.thermometer_devs = config.get('thermometers', {})
+
+        self.zones = [Zone(history_capacity=history_capacity, **z) for z in config['zones']]
+        self.by_name = {z.name: z for z in self.zones}
+        if len(self.by_name) != len(self.zones):
+            raise ValueError('Zone names must be unique')
+
+        used = set()
+        for z in self.zones:
+            if z.supply not in self.supply_ips:
+                raise ValueError(f'Zone {z.name}: unknown supply {z.supply}')
+            if z.thermometer not in self.thermometer_devs and z.thermometer not in (thermometers or {}):
+                raise ValueError(f'Zone {z.name}: unknown thermometer {z.thermometer}')
+            if z.input not in ('t1', 't2'):
+                raise ValueError(f'Zone {z.name}: sensor input must be t1 or t2')
+            if not z.channels:
+                raise ValueError(f'Zone {z.name}: no channels')
+            for ch in z.allocated():
+                if (z.supply, ch) in used:
+                    raise ValueError(f'Zone {z.name}: {z.supply} CH{ch} is allocated twice')
+                used.add((z.supply, ch))
+
+        # Only the supplies and thermometers some zone uses are connected
+        instrs = instrs or {}
+        self.instrs = {}
+        for name in sorted({z.supply for z in self.zones}):
+            self.instrs[name] = dp832.DP832(self.supply_ips[name], instr=instrs.get(name))
+            idn = self.instrs[name].ask('*IDN?')
+            print(f'{name}: {idn}')
+            if not idn.startswith('RIGOL TECHNOLOGIES,DP832'):
+                raise ValueError(f'{name}: unknown instrument: {idn}')
+        self.supply_zones = {name: [z for z in self.zones if z.supply == name] for name in self.instrs}
+
+        thermometers = thermometers or {}
+        self.thermometers = {}
+        for name in sorted({z.thermometer for z in self.zones}):
+            if name in thermometers:
+                self.thermometers[name] = thermometers[name]
+            else:
+                ea15 = extech_ea15.ExtechEA15Threaded(self.thermometer_devs[name], timeformat='dt')
+                ea15.run()
+                self.thermometers[name] = ea15
+        self.last_mono = {name: None for name in self.thermometers}
+        self.sample_clocks = {name: extech_ea15.SampleClock() for name in self.thermometers}
+        self.samples_dropped = 0
+        self.samples_duplicate = 0
+
+        self.pool = concurrent.futures.ThreadPoolExecutor(len(self.instrs), thread_name_prefix='supply')
+
+    def save_config(self):
+        config = {'supplies': self.supply_ips, 'thermometers': self.thermometer_devs,
+                  'zones': [z.config() for z in self.zones]}
+        with open(self.config_fn, 'w') as f:
+            json.dump(config, f, indent=2)
+            print(file=f)
+
+    def set_pid(self, zone, target_temp, kp, ki, kd):
+        z = self.by_name[zone]
+        z.target_temp = target_temp
+        z.kp = kp
+        z.ki = ki
+        z.kd = kd
+
+        self.save_config()
+
+    def reset_i(self, zone=None):
+        for z in self.zones if zone is None else [self.by_name[zone]]:
+            z.term_i = 0
+
+    def setup(self):
+        for name, instr in self.instrs.items():
+            instr.write('*RST')
+            instr.write('*CLS')
+            for z in self.supply_zones[name]:
+                z.setup(instr)
+            instr.flush()
+
+    def shutdown(self):
+        # Leave every allocated channel off
+        for name, instr in self.instrs.items():
+            for z in self.supply_zones[name]:
+                for ch in z.allocated():
+                    instr.set_output(ch, False)
+            instr.flush()
+        self.pool.shutdown()
+
+    def poll(self):
+        # The newest new sample of each thermometer, older queued ones are dropped
+        samples = {}
+        for name, ea15 in self.thermometers.items():
+            v = None
+            while True:
+                try:
+                    v2 = ea15.get(False)
+                except queue.Empty:
+                    break
+                if v is not None:
+                    self.samples_dropped += 1
+                v = v2
+            if v is None:
+                continue
+            if self.last_mono[name] is not None and v.mono <= self.last_mono[name]:
+                self.samples_duplicate += 1
+                continue
+            self.last_mono[name] = v.mono
+            self.sample_clocks[name].update(v.mono)
+            samples[name] = v
+        return samples
+
+    def cycle(self, name):
+        # One transaction on a supply: its zones' settings, then all their measurements
+        instr = self.instrs[name]
+        zones = self.supply_zones[name]
+        for z in zones:
+            z.apply(instr)
+        chs = sorted(ch for z in zones for ch in z.channels)
+        meas = dict(zip(chs, instr.measure_all(chs)))
+        for z in zones:
+            z.record(meas)
+
+    def step(self, v=None):
+        # v is ignored, the thermometers are polled. Zones without a new sample
+        # keep their current, and their supplies are still measured.
+        samples = self.poll()
+        for z in self.zones:
+            if z.thermometer in samples:
+                z.update(samples[z.thermometer], self.sample_clocks[z.thermometer].period)
+
+        for f in [self.pool.submit(self.cycle, name) for name in self.instrs]:
+            f.result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Closed-loop control of many TEC zones')
+    parser.add_argument('config', help='zones file')
+    parser.add_argument('--period', type=float, default=1., help='control period, s')
+    args = parser.parse_args()
+
+    mzc = MultiZoneController(args.config)
+    mzc.setup()
+    worker = tec_control.ControlWorker(mzc, period=args.period)
+    worker.start()
+
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *args: stop.set())
+    try:
+        while not stop.wait(1.):
+            if not worker.thread.is_alive():
+                print('Control thread stopped, shutting down')
+                break
+    finally:
+        worker.stop()
+        mzc.shutdown()
+
+
+if __name__ == "__main__":
+    main()